@@ -2,13 +2,22 @@
 import sys
 import Tkinter, tkFileDialog
 
-# Third Party Libraries
-import pylab
-from scipy import misc
-
 # Local Libraries
+import combine
 import read
 
+# Precision of the running means, threads decoding the images of a group
+# and processes averaging independent groups.
+dtype = 'float32'
+threads = 4
+processes = 1
+
+# Robust combination against cosmic rays and saturated shots: None for the
+# plain mean, or 'clip', 'median', 'minmax' or 'mean' (see combine.robust).
+# Variance maps for fit weights are written to ./average/variance.
+method = None
+variances = False
+
 # Use Tk dialog for choosing the top-level directory
 root = Tkinter.Tk()
 root.withdraw()
@@ -21,27 +30,13 @@ if top_dir is '':
 # Recursively find parsable files, allowed file types is currently hard-
 # coded in read.py. Does not check for consistency between images.
 image_paths = read.find_images(top_dir)
-if image_paths is None:
-    'No parsable files could be found, quitting...'
+if not image_paths:
+    print 'No parsable files could be found, quitting...'
     sys.exit(0)
 
-pylab.ion()
-addressed = []
-for image_path in image_paths:
-    name = image_path[-8:]
-    if name in addressed:
-        print 'Finished!'
-        break
-    addressed.append(name)
-    same = [i for i in image_paths if name in i]
-    items = len(same)
-    im = pylab.imread(same.pop(0))
-    im = im.astype(pylab.float64)
-    for file in same:
-        next = pylab.imread(file)
-        next = next.astype(pylab.float64)
-        im += next
-    mean = im/items
-    new_im = misc.toimage(mean)
-    print 'Saving to', './average/' + name
-    new_im.save('./average/' + name, 'TIFF')
+# Files of the same name in the subdirectories are repeats of one frame.
+groups = combine.index(image_paths)
+for path in combine.average(groups, './average', dtype, threads, processes,
+                            method, variances):
+    print 'Saved', path
+print 'Finished!'
@@ -0,0 +1,199 @@
+""" Generation and on-disk storage of template banks, the matrices of
+normalized synthetic spectra (temperatures x pixels) that measured spectra
+are compared against. A bank only depends on the transition, the detector
+wavelength axis, the slit and the temperature grid, so it is stored as a
+.npy file named after a hash of all of those inputs together with a small
+JSON header describing them. Later runs, and other processes, map the
+file read-only instead of synthesizing the spectra again. Any change of
+the inputs gives a different hash, stale banks are never read and are
+eventually removed when the store exceeds its size limit.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+import pylab
+
+import lineshape
+import spectrum
+import temperature
+
+# Bumped whenever the way templates are computed changes, which
+# invalidates every stored bank.
+version = 1
+
+def templates(istate, vi, fstate, vf, Jmax, wavelengths, temperatures, fwhm,
+              linetype=1, eta=None, synthesis='direct'):
+    """ templates(istate, vi, fstate, vf, Jmax, wavelengths, temperatures,
+    fwhm[, linetype[, eta[, synthesis]]]) -> templates
+
+    Synthesizes the spectra of the transition at every temperature on the
+    given wavelength axis and returns them as a (temperatures x pixels)
+    array, each row normalized to a maximum of one. The synthesis is either
+    'direct' (lineshape.synthesize) or 'convolve' (spectrum.binlines
+    followed by lineshape.broaden).
+    """
+    wavelengths = pylab.asarray(wavelengths, dtype=float)
+    lines, strengths, rotational = temperature.branches(istate, vi, fstate,
+                                                        vf, Jmax)
+    intensities = temperature.populations(strengths, rotational, Jmax,
+                                          pylab.atleast_1d(temperatures))
+    if synthesis == 'direct':
+        output = lineshape.synthesize(lines, intensities, wavelengths, fwhm,
+                                      linetype, eta)
+    elif synthesis == 'convolve':
+        output = spectrum.binlines(lines, intensities, wavelengths)
+        spacing = (wavelengths[-1] - wavelengths[0]) / (len(wavelengths) - 1)
+        output = lineshape.broaden(output, spacing, fwhm, linetype, eta)
+    else:
+        raise ValueError('The synthesis must be \'direct\' or \'convolve\'.')
+    return output / abs(output).max(axis=1)[:, None]
+
+def describe(state, v):
+    """ describe(state, v) -> dict, identifies a molecular state by its
+    class and the constants it provides for vibrational level v.
+    """
+    return {'state': '%s.%s' % (type(state).__module__, type(state).__name__),
+            'v': v, 'E': state.E(v), 'B': state.B(v), 'D': state.D(v),
+            'Y': state.Y(v)}
+
+def open_bank(path):
+    """ open_bank(path) -> templates, maps a stored bank read-only.
+    """
+    return pylab.load(path, mmap_mode='r')
+
+class TemplateBank(object):
+    """ A directory of stored template banks. Banks are looked up by a
+    hash of every input that affects them and generated with templates()
+    on a miss. The total size of the stored banks is kept below size
+    bytes by removing the least recently used ones.
+    """
+
+    def __init__(self, directory=None, size=2**30):
+        """ TemplateBank([directory[, size]]), opens (and creates) the
+        store, by default in ~/.rovib/templates.
+        """
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.rovib',
+                                     'templates')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.size = size
+
+    def header(self, istate, vi, fstate, vf, Jmax, wavelengths, temperatures,
+               fwhm, linetype=1, eta=None, synthesis='direct'):
+        """ TemplateBank.header(...) -> key, header, returns the hash of
+        the inputs and the metadata stored alongside the bank. Takes the
+        same arguments as templates().
+        """
+        wavelengths = pylab.asarray(wavelengths, dtype=float)
+        temperatures = pylab.atleast_1d(pylab.asarray(temperatures,
+                                                      dtype=float))
+        if isinstance(linetype, lineshape.Instrument):
+            slit = 'instrument:' + linetype.key
+        else:
+            slit = linetype
+        header = {'version': version,
+                  'initial': describe(istate, vi),
+                  'final': describe(fstate, vf),
+                  'Jmax': Jmax,
+                  'pixels': len(wavelengths),
+                  'start': wavelengths[0],
+                  'end': wavelengths[-1],
+                  'temperatures': temperatures.tolist(),
+                  'fwhm': fwhm,
+                  'linetype': slit,
+                  'eta': eta,
+                  'synthesis': synthesis}
+        digest = hashlib.sha1(json.dumps(header, sort_keys=True).encode())
+        digest.update(wavelengths.tobytes())
+        return digest.hexdigest(), header
+
+    def path(self, key):
+        """ TemplateBank.path(key) -> path of the stored bank for key.
+        """
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, istate, vi, fstate, vf, Jmax, wavelengths, temperatures,
+            fwhm, linetype=1, eta=None, synthesis='direct'):
+        """ TemplateBank.get(...) -> templates, returns the read-only,
+        memory mapped bank for the inputs, generating and storing it first
+        if necessary. Takes the same arguments as templates().
+        """
+        args = (istate, vi, fstate, vf, Jmax, wavelengths, temperatures, fwhm,
+                linetype, eta, synthesis)
+        key, header = self.header(*args)
+        path = self.path(key)
+        try:
+            bank = open_bank(path)
+        except IOError:
+            pass
+        else:
+            # The time of last use only orders eviction, a read-only store
+            # is used as it is.
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+            return bank
+
+        bank = templates(*args)
+        header['created'] = time.time()
+        header['shape'] = bank.shape
+        self._write(path, bank, header)
+        self.evict(keep=key)
+        return open_bank(path)
+
+    def _write(self, path, bank, header):
+        """ Writes the bank and its header through temporary files, which
+        are renamed into place so that a concurrent reader never sees a
+        partial file.
+        """
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary, 'wb') as fid:
+            pylab.save(fid, bank)
+        os.rename(temporary, path)
+        meta = os.path.splitext(path)[0] + '.json'
+        with open(temporary, 'w') as fid:
+            json.dump(header, fid, indent=1, sort_keys=True)
+        os.rename(temporary, meta)
+
+    def entries(self):
+        """ TemplateBank.entries() -> list of (last use, size, key) for the
+        stored banks, least recently used first.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            key, extension = os.path.splitext(name)
+            if extension != '.npy':
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, key))
+        entries.sort()
+        return entries
+
+    def evict(self, keep=None):
+        """ TemplateBank.evict([keep]), removes the least recently used
+        banks until the store fits in its size limit. The bank for key
+        keep is never removed.
+        """
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        for used, size, key in entries:
+            if total <= self.size:
+                break
+            if key == keep:
+                continue
+            for path in (self.path(key),
+                         os.path.join(self.directory, key + '.json')):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
@@ -0,0 +1,322 @@
+"""
+Headless batch analysis of a directory of spectrum images.
+
+Runs the analysis of main.py without any interaction: the image directory
+and the settings file written by config.py are given on the command line,
+the template bank is built (or loaded from the store) once, and the frames
+are streamed through the stages of pipeline.py, with a pool of worker
+processes that map the bank read-only doing the per-frame work. Results
+are written in time order as they arrive, memory use does not grow with
+the number of frames.
+
+With --watch the directory is watched for images still being acquired,
+which are fitted as soon as they are completely written and appended to
+the results together with their path, a restarted run skips the images
+whose path is already in the results. Results are kept in a store keyed
+by the image, the settings and the model (see results.py), so reruns and
+interrupted runs only fit the frames that are missing or whose inputs
+changed.
+
+Usage: python batch.py directory [-s settings.pickle] [-p processes] ...
+       python batch.py --help for the full list of options.
+
+Requires: Numpy, Scipy, Matplotlib
+"""
+
+# Standard Libraries
+import argparse
+import itertools
+import multiprocessing
+import os
+import sys
+
+# Third Party Libraries
+import pylab
+
+# Local Libraries
+import bank
+import calibrate
+import config
+import fit
+import lineshape
+import pipeline
+import results
+import spectrum
+import surrogate
+import watch
+from gases import N2
+
+def slit(options):
+    """ slit(options) -> linetype of the synthetic spectra, the measured
+    instrument function if one is given.
+    """
+    if options.instrument:
+        return lineshape.Instrument.load(options.instrument)
+    return options.linetype
+
+def recorded(output):
+    """ recorded(output) -> set of the image paths in the results of a
+    watched run.
+    """
+    with open(output) as fid:
+        return set(fields[4].strip() for fields in
+                   (line.split(',', 4) for line in fid) if len(fields) == 5)
+
+def parse(argv=None):
+    parser = argparse.ArgumentParser(description='Fits rotational '
+                                     'temperatures to a directory of spectrum '
+                                     'images without user interaction.')
+    parser.add_argument('directory', help='directory searched (recursively) '
+                        'for images')
+    parser.add_argument('-s', '--settings', help='settings file written by '
+                        'main.py, default: directory/settings.pickle')
+    parser.add_argument('-o', '--output', default='results.csv',
+                        help='CSV file of time, temperature, error and signal')
+    parser.add_argument('-p', '--processes', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--depth', type=int, default=4,
+                        help='frames in flight per worker process')
+    parser.add_argument('--threads', type=int, default=2,
+                        help='threads decoding images ahead of the fit '
+                        '(single process only)')
+    parser.add_argument('--prefetch', type=int, default=4,
+                        help='images decoded ahead of the fit')
+    parser.add_argument('--whole', action='store_true',
+                        help='read whole images instead of only the rows '
+                        'of the regions')
+    parser.add_argument('--fwhm', type=float, default=1.30e-10,
+                        help='full-width half maximum of spectral line')
+    parser.add_argument('--linetype', type=int, default=1, choices=(1, 2, 3),
+                        help='slit profile, 1: Gaussian, 2: Lorentzian, '
+                        '3: pseudo-Voigt')
+    parser.add_argument('--eta', type=float,
+                        help='Lorentzian fraction of the pseudo-Voigt')
+    parser.add_argument('--instrument', help='measured lamp line '
+                        '(wavelength, intensity CSV) used as the slit, the '
+                        'fwhm is then not fitted')
+    parser.add_argument('--synthesis', default='convolve',
+                        choices=('convolve', 'direct'),
+                        help='map the lines onto the detector and broaden '
+                        '(as main.py does by default), or evaluate the line '
+                        'profiles directly')
+    parser.add_argument('--temperatures', type=float, nargs=3,
+                        default=(250, 1500, 50), metavar=('START', 'END',
+                                                          'STEP'),
+                        help='temperature grid of the template bank')
+    parser.add_argument('--jmax', type=int, default=50,
+                        help='highest rotational level')
+    parser.add_argument('--noise', type=float, default=0.20,
+                        help='signal below which frames are skipped')
+    parser.add_argument('--pixel', type=int, default=784,
+                        help='pixel whose intensity is the signal')
+    parser.add_argument('--dt', type=float, default=500e-12,
+                        help='time step between frames')
+    parser.add_argument('--shift', type=float, default=0.04e-9,
+                        help='shift of the measured wavelengths')
+    parser.add_argument('--calibrate', type=int, default=0, metavar='SEGMENTS',
+                        help='align every frame with the templates by cross-'
+                        'correlation, with a linear dispersion for more than '
+                        'one segment')
+    parser.add_argument('--binning', type=int,
+                        help='also fit the temperature along the slit in '
+                        'bins of this many lines')
+    parser.add_argument('--map', default='map.csv',
+                        help='CSV file of time and the temperatures along the '
+                        'slit, the first line holds the bin positions')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep fitting images as they are written to the '
+                        'directory, appending to the results')
+    parser.add_argument('--interval', type=float, default=0.2,
+                        help='seconds between polls of the watched directory')
+    parser.add_argument('--timeout', type=float,
+                        help='stop watching after this many seconds without '
+                        'a new image')
+    parser.add_argument('--cache', help='result store, default: '
+                        '~/.rovib/results.sqlite')
+    parser.add_argument('--fresh', action='store_true',
+                        help='fit every frame again, replacing stored results')
+    parser.add_argument('--content', action='store_true',
+                        help='identify images by a hash of their content '
+                        'instead of their size and modification time')
+    parser.add_argument('--bank', help='template bank store, default: '
+                        '~/.rovib/templates')
+    return parser.parse_args(argv)
+
+class Analysis(object):
+    """ The per-frame stages of the pipeline, from loading the image to the
+    fit, with the template bank mapped read-only. One instance lives in
+    every worker process.
+    """
+
+    def __init__(self, settings, options, bank_path):
+        self.settings = settings
+        self.options = options
+        start, end, step = options.temperatures
+        self.temperatures = pylab.arange(start, end + step, step)
+        self.templates = bank.open_bank(bank_path)
+        free = fit.names
+        if options.instrument:
+            free = tuple(name for name in free if name != 'fwhm')
+        self.fitter = pipeline.Fitter(self.templates, self.temperatures,
+                                      N2.C3Piu(), 0, N2.B3Pig(), 0,
+                                      options.jmax, options.fwhm,
+                                      slit(options), free, options.watch,
+                                      options.eta, options.synthesis)
+        self.calibration = None
+        if options.calibrate:
+            self.calibration = calibrate.Calibration(self.templates,
+                                                     options.calibrate)
+        self.surrogate = None
+        if options.binning:
+            self.surrogate = surrogate.Surrogate(self.temperatures,
+                                                 self.templates)
+
+    def process(self, frames):
+        """ Analysis.process(frames) -> generator of analysed frames.
+        """
+        return self.reduce(pipeline.load(frames, self.settings))
+
+    def reduce(self, frames):
+        """ Analysis.reduce(frames) -> generator of analysed frames, for
+        frames whose images are already loaded.
+        """
+        frames = pipeline.collapse(frames, self.options.shift,
+                                   self.options.binning)
+        frames = pipeline.prefilter(frames, self.options.noise,
+                                    self.options.pixel)
+        if self.calibration is not None:
+            frames = pipeline.calibrate(frames, self.calibration)
+        frames = pipeline.resolve(frames, self.templates, self.temperatures,
+                                  self.options.noise, self.options.pixel,
+                                  self.surrogate)
+        frames = pipeline.fit(frames, self.fitter)
+        for frame in frames:
+            frame.spectrum = None
+            yield frame
+
+# Analysis of the current worker process, see _initialize().
+_analysis = None
+
+def _initialize(settings, options, bank_path):
+    global _analysis
+    _analysis = Analysis(settings, options, bank_path)
+
+def _process(frame):
+    return next(_analysis.process([frame]))
+
+def run(options):
+    settings_path = options.settings or os.path.join(options.directory,
+                                                     'settings.pickle')
+    settings = config.read(settings_path)
+    if not settings:
+        print('Could not read the settings from %s, quitting...'
+              % settings_path)
+        return 1
+    settings = dict(settings, lazy=not options.whole)
+
+    # A watched run appends, skipping the images already in the results.
+    done = set()
+    if options.watch and os.path.exists(options.output):
+        done = recorded(options.output)
+    if options.watch:
+        frames = iter(watch.Watcher(options.directory, options.interval, done,
+                                    options.timeout))
+    else:
+        frames = pipeline.discover(options.directory)
+    try:
+        first = next(frames)
+    except StopIteration:
+        if done:
+            print('No new images in %s, quitting...' % options.directory)
+            return 0
+        print('No parsable files could be found, quitting...')
+        return 1
+    frames = itertools.chain([first], frames)
+
+    # The bank is built once here, the workers only map the stored file.
+    image = spectrum.SpectrumImage(first.path, **settings)
+    measured = image.collapse()
+    start, end, step = options.temperatures
+    store = bank.TemplateBank(options.bank)
+    transition = (N2.C3Piu(), 0, N2.B3Pig(), 0, options.jmax,
+                  measured.wavelengths + options.shift,
+                  pylab.arange(start, end + step, step), options.fwhm,
+                  slit(options), options.eta, options.synthesis)
+    templates = store.get(*transition)
+    args = (settings, options, templates.filename)
+
+    # Stored results are looked up by hashes of everything that reduces an
+    # image to a spectrum and of everything that is fitted to it.
+    reduction = results.digest(
+        dict((key, value) for key, value in settings.items()
+             if key != 'lazy'),
+        options.shift, options.noise, options.pixel, options.calibrate,
+        options.binning)
+    model = results.digest(store.header(*transition)[0], fit.names,
+                           options.watch)
+    cache = results.ResultStore(options.cache)
+    stored = {} if options.fresh else cache.load(reduction, model)
+    frames = pipeline.lookup(frames, stored, options.content)
+
+    # Worker processes load their own images, a single process overlaps
+    # loading with the fit on a thread pool. Watching, frames are handled
+    # one at a time as they arrive.
+    waits = {}
+    if options.watch:
+        pool = None
+        frames = pipeline.load(frames, settings)
+        frames = pipeline.timed(frames, 'load', waits)
+        frames = Analysis(*args).reduce(frames)
+    elif options.processes > 1:
+        pool = multiprocessing.Pool(options.processes, _initialize, args)
+        frames = pipeline.parallel(frames, _process, pool,
+                                   options.depth * options.processes)
+    else:
+        pool = None
+        frames = pipeline.prefetch(frames, settings, options.threads,
+                                   options.prefetch)
+        frames = pipeline.timed(frames, 'load', waits)
+        frames = Analysis(*args).reduce(frames)
+    frames = pipeline.record(frames, cache, reduction, model)
+    frames = pipeline.timed(frames, 'analysis', waits)
+
+    mode = 'a' if options.watch else 'w'
+    fid = open(options.output, mode)
+    frames = pipeline.sink(frames, fid, options.dt, options.watch)
+    if options.binning:
+        plan = spectrum.CollapsePlan.fromimage(image)
+        fresh = not options.watch or not os.path.exists(options.map)
+        mapfid = open(options.map, mode)
+        if fresh:
+            mapfid.write('# line, %s\n' % ', '.join(
+                '%g' % position
+                for position in plan.positions(options.binning)))
+        frames = pipeline.sinkmap(frames, mapfid, options.dt)
+    count = 0
+    reused = 0
+    try:
+        for frame in frames:
+            count += 1
+            reused += frame.cached
+            if options.watch:
+                print('%g s: %g K' % (options.dt * frame.index,
+                                      frame.temperature))
+    except KeyboardInterrupt:
+        print('Interrupted, the stored results are kept for the next run.')
+    finally:
+        cache.close()
+    fid.close()
+    if options.binning:
+        mapfid.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print('Analysed %d frames (%d from the store), results written to %s'
+          % (count, reused, options.output))
+    for name in sorted(waits):
+        print('Waited %.2f s on %s' % (waits[name], name))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(run(parse()))
@@ -0,0 +1,253 @@
+""" Per-frame wavelength calibration by FFT cross-correlation. A stretch of
+the measured spectrum is correlated with a synthetic reference on the same
+nominal wavelength axis, and the peak of the correlation, refined to a
+fraction of a pixel by a parabola through its neighbours, gives the shift
+of the frame. The stretch slides over the whole reference, extended at the
+ends by its edge values, and the correlation at every lag is normalized by
+the spread of the reference under the stretch, so the overlap is complete
+at every lag and the peak is not pulled towards zero shift for broad lines.
+The estimate is repeated on the frame aligned with the first one and the
+residual shift added. The shape of a band changes with temperature, and a
+reference of another temperature, or the mean of a template bank, has its
+features elsewhere and biases the shift. Given a bank, every frame is
+therefore correlated with the template it matches best.
+
+Correlating segments of the aligned frame separately gives a shift per
+segment, a line through them adds a linear dispersion correction. The
+segments only search a small range around the alignment, so the nearly
+regular lines of a branch cannot pull a segment to a neighbouring line. A
+band usually fills only part of the axis, so segments are weighted by
+their correlation and only those carrying a significant part of it count.
+Unless at least two of them do, and they are far enough apart to
+determine a slope, the shift of the whole axis is used without a
+dispersion correction. The transforms of a template are computed the
+first time it is used and the frames of a stack are transformed together.
+Frames are then resampled onto the nominal axis, so the template bank and
+fit models built for it stay valid.
+"""
+
+import pylab
+
+import match
+
+class Calibration(object):
+    """ Cross-correlation against a fixed reference spectrum, or against
+    the best matching one of a bank. Calling the calibration with a
+    spectrum returns its shift and dispersion, align() resamples it to
+    match the reference.
+    """
+
+    def __init__(self, reference, segments=1, maxshift=None, passes=2,
+                 significance=0.1):
+        """ Calibration(reference[, segments[, maxshift[, passes[,
+        significance]]]])
+
+        The reference holds the intensities of a synthetic spectrum on the
+        nominal wavelength axis of the frames, or a (templates x pixels)
+        bank of them, such as the template bank. With a bank every frame
+        is correlated with the template of the smallest match.errors(),
+        chosen again after the first alignment. Shifts are searched up to maxshift pixels, by
+        default half a segment. Every one of passes estimates refines the
+        previous one. With more than one segment a linear dispersion is
+        estimated from the second pass on, at least two are made then, with
+        the segments searching an eighth of their length around the
+        alignment. Segments whose correlation is below significance times
+        the largest one are ignored for the dispersion.
+        """
+        self.references = pylab.atleast_2d(reference)
+        if segments < 1:
+            raise ValueError('There must be at least one segment.')
+        self.pixels = self.references.shape[-1]
+        self.segments = segments
+        self.length = self.pixels // segments
+        if self.length < 3:
+            raise ValueError('The segments must be at least 3 pixels long.')
+        if maxshift is None:
+            maxshift = self.length // 2
+        self.maxshift = int(min(maxshift, self.length - 2))
+        if self.maxshift < 1:
+            raise ValueError('The largest shift must be at least one pixel.')
+        self.passes = passes
+        if segments > 1:
+            self.passes = max(passes, 2)
+        self.significance = significance
+        self.correlators = {}
+
+    def __call__(self, intensities):
+        """ calibration(intensities) -> offsets, slopes
+
+        Returns the shift in pixels of a spectrum, or of each one of a
+        (frames x pixels) stack, against the reference at the centre of
+        the axis, and the change of the shift per pixel (zero for a single
+        segment). A frame with a positive shift shows the features of the
+        reference at larger pixel indices.
+        """
+        intensities = pylab.asarray(intensities, dtype=float)
+        if intensities.shape[-1] != self.pixels:
+            raise ValueError('The spectra must have as many pixels as the '
+                             'reference.')
+        single = intensities.ndim == 1
+        intensities = pylab.atleast_2d(intensities)
+        chosen = self.choose(intensities)
+        offsets = self._correlate(0, intensities, chosen)[0][:, 0]
+        slopes = pylab.zeros(offsets.shape)
+        for i in range(1, self.passes):
+            aligned = self.align(intensities, offsets, slopes)
+            if i == 1:
+                chosen = self.choose(aligned)
+            offset, slope = self._estimate(aligned, chosen)
+            offsets = offsets + offset
+            slopes = slopes + slope
+        if single:
+            return offsets[0], slopes[0]
+        return offsets, slopes
+
+    def choose(self, intensities):
+        """ Calibration.choose(intensities) -> index of the reference
+        each frame of a (frames x pixels) stack is correlated with.
+        """
+        if len(self.references) == 1:
+            return pylab.zeros(len(intensities), dtype=int)
+        return pylab.argmin(match.errors(intensities, self.references),
+                            axis=-1)
+
+    def _correlate(self, part, intensities, chosen):
+        # Shifts, weights and feature centroids (frames x count) of the
+        # frames against the whole (part 0) or the segments (part 1) of
+        # their references.
+        count = self.segments if part else 1
+        shifts = pylab.empty((len(intensities), count))
+        weights = pylab.empty((len(intensities), count))
+        centres = pylab.empty((len(intensities), count))
+        for index in pylab.unique(chosen):
+            if index not in self.correlators:
+                self.correlators[index] = self._correlators(index)
+            correlator = self.correlators[index][part]
+            selected = chosen == index
+            shifts[selected], weights[selected] = \
+                correlator(intensities[selected])
+            centres[selected] = correlator.centres
+        return shifts, weights, centres
+
+    def _correlators(self, index):
+        # Correlators of the whole axis and of the segments of a reference.
+        reference = pylab.asarray(self.references[index], dtype=float)
+        whole = _Correlator(reference, 1, self.pixels, self.maxshift)
+        parts = None
+        if self.segments > 1:
+            parts = _Correlator(reference, self.segments, self.length,
+                                min(self.maxshift, max(1, self.length // 8)))
+        return whole, parts
+
+    def _estimate(self, intensities, chosen):
+        shift = self._correlate(0, intensities, chosen)[0][:, 0]
+        slopes = pylab.zeros(shift.shape)
+        if self.segments == 1:
+            return shift, slopes
+
+        # Line through the shifts of the significant segments, weighted by
+        # their correlation, at the centroids of the reference features.
+        shifts, weights, centres = self._correlate(1, intensities, chosen)
+        largest = weights.max(axis=-1)[..., None]
+        weights = pylab.where((weights > 0) &
+                              (weights >= self.significance * largest),
+                              weights, 0)
+        total = weights.sum(axis=-1)
+        total = pylab.where(total > 0, total, 1)
+        mean = (weights * centres).sum(axis=-1) / total
+        x = centres - mean[..., None]
+        spread = (weights * x**2).sum(axis=-1)
+        slope = (weights * x * shifts).sum(axis=-1) / \
+            pylab.where(spread > 0, spread, 1)
+        offset = (weights * shifts).sum(axis=-1) / total + \
+            slope * ((self.pixels - 1) / 2.0 - mean)
+
+        # The slope needs two significant segments whose centroids spread
+        # over at least a quarter of a segment, otherwise it is noise.
+        usable = ((weights > 0).sum(axis=-1) >= 2) & \
+            (spread / total >= (self.length / 4.0)**2)
+        return (pylab.where(usable, offset, shift),
+                pylab.where(usable, slope, slopes))
+
+    def align(self, intensities, offsets, slopes=0.0):
+        """ Calibration.align(intensities, offsets[, slopes]) -> resampled
+
+        Linearly interpolates a spectrum, or a stack of them, at the
+        pixels of the reference given the shifts from calling the
+        calibration. The shifts of a single frame may also be applied to a
+        stack, such as the rows of a frame.
+        """
+        intensities = pylab.asarray(intensities, dtype=float)
+        pixels = pylab.arange(intensities.shape[-1], dtype=float)
+        centre = (self.pixels - 1) / 2.0
+        offsets = pylab.asarray(offsets, dtype=float)[..., None]
+        slopes = pylab.asarray(slopes, dtype=float)[..., None]
+        positions = pixels + offsets + slopes * (pixels - centre)
+        positions = pylab.clip(positions, 0, len(pixels) - 1)
+        positions = positions + pylab.zeros(intensities.shape)
+        lower = pylab.minimum(positions.astype(int), len(pixels) - 2)
+        fraction = positions - lower
+        return (1 - fraction) * pylab.take_along_axis(intensities, lower, -1) \
+            + fraction * pylab.take_along_axis(intensities, lower + 1, -1)
+
+class _Correlator(object):
+    # Normalized cross-correlation of consecutive stretches of a spectrum
+    # with the reference. Stretch i of length pixels is compared with the
+    # reference over the same pixels widened by maxshift on either side,
+    # so the transforms and the spread of the reference under the stretch
+    # at every lag are computed once.
+
+    def __init__(self, reference, count, length, maxshift):
+        self.count = count
+        self.length = length
+        self.maxshift = maxshift
+        padded = pylab.concatenate((pylab.repeat(reference[:1], maxshift),
+                                    reference,
+                                    pylab.repeat(reference[-1:], maxshift)))
+        starts = pylab.arange(count) * length
+        windows = padded[starts[:, None] +
+                         pylab.arange(length + 2 * maxshift)]
+        self.nfft = 2**int(pylab.ceil(pylab.log2(length + 2 * maxshift)))
+        self.transform = pylab.rfft(windows, self.nfft)
+
+        lags = 2 * maxshift + 1
+        sums = pylab.cumsum(pylab.column_stack((pylab.zeros(count),
+                                                windows)), axis=-1)
+        squares = pylab.cumsum(pylab.column_stack((pylab.zeros(count),
+                                                   windows**2)), axis=-1)
+        total = sums[:, length:length + lags] - sums[:, :lags]
+        energy = squares[:, length:length + lags] - squares[:, :lags]
+        self.spread = pylab.maximum(energy - total**2 / length, 0)**0.5
+
+        segments = windows[:, maxshift:maxshift + length]
+        deviation = (segments - segments.mean(axis=-1)[:, None])**2
+        power = deviation.sum(axis=-1)
+        middle = (deviation * pylab.arange(length)).sum(axis=-1) / \
+            pylab.where(power > 0, power, 1)
+        self.centres = starts + pylab.where(power > 0, middle,
+                                            (length - 1) / 2.0)
+
+    def __call__(self, intensities):
+        # Shifts and correlation peaks (... x count) of the stretches.
+        used = intensities[..., :self.count * self.length]
+        used = used.reshape(used.shape[:-1] + (self.count, self.length))
+        used = used - used.mean(axis=-1)[..., None]
+        spectra = pylab.rfft(used, self.nfft)
+        correlation = pylab.irfft(spectra.conj() * self.transform,
+                                  self.nfft)[..., :2 * self.maxshift + 1]
+        normalized = correlation / pylab.where(self.spread > 0, self.spread,
+                                               pylab.inf)
+
+        peak = pylab.clip(pylab.argmax(normalized, axis=-1), 1,
+                          2 * self.maxshift - 1)[..., None]
+        c0 = pylab.take_along_axis(normalized, peak - 1, -1)[..., 0]
+        c1 = pylab.take_along_axis(normalized, peak, -1)[..., 0]
+        c2 = pylab.take_along_axis(normalized, peak + 1, -1)[..., 0]
+        curvature = c0 - 2 * c1 + c2
+        fraction = pylab.where(curvature < 0, 0.5 * (c0 - c2) /
+                               pylab.where(curvature < 0, curvature, -1), 0)
+        shifts = self.maxshift - peak[..., 0] - pylab.clip(fraction, -0.5,
+                                                           0.5)
+        weights = pylab.maximum(pylab.take_along_axis(correlation, peak,
+                                                      -1)[..., 0], 0)
+        return shifts, weights
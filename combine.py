@@ -0,0 +1,207 @@
+""" Averaging of repeated images. Acquisitions repeated into several
+directories hold files of the same name, the last characters of the path,
+for the same frame. The paths are grouped by name in one pass, each group
+is reduced by a running mean while its members are decoded on a pool of
+threads, and independent groups may be spread over worker processes.
+
+Groups with cosmic ray hits or saturated shots are better reduced by
+robust(), which offers a sigma clipped mean, the median and min/max
+rejection along with a variance map. It works through blocks of rows of
+all members at once, sized to a memory budget, so memory does not grow
+with the size of the group for uncompressed (memory-mapped) images.
+Compressed images cannot be read by rows and are decoded whole, every
+member of the group is then held in memory at once.
+"""
+
+import os
+from collections import OrderedDict, deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import pylab
+
+import tiff
+
+def index(image_paths, length=8):
+    """ index(image_paths[, length]) -> OrderedDict of name: paths
+
+    Groups the paths by their last length characters, in the order each
+    name is first seen.
+    """
+    groups = OrderedDict()
+    for path in image_paths:
+        groups.setdefault(path[-length:], []).append(path)
+    return groups
+
+def mean(paths, dtype=pylab.float32, threads=4):
+    """ mean(paths[, dtype[, threads]]) -> mean image
+
+    Streams the images through a running mean held in dtype, so that only
+    the mean and the images being decoded by the threads, at most two per
+    thread, are in memory. All images must have the same shape.
+    """
+    pool = ThreadPool(threads)
+    try:
+        output = None
+        images = _readahead(paths, pool, 2 * threads)
+        for count, image in enumerate(images, 1):
+            if output is None:
+                output = image.astype(dtype)
+            elif image.shape != output.shape:
+                raise ValueError('The images of a group must have the same '
+                                 'shape.')
+            else:
+                output += (image - output) / count
+    finally:
+        pool.terminate()
+    return output
+
+def robust(paths, method='clip', sigma=3.0, iterations=3, reject=1,
+           dtype=pylab.float32, memory=2**26):
+    """ robust(paths[, method[, sigma[, iterations[, reject[, dtype[,
+    memory]]]]]]) -> image, variance
+
+    Combines the images pixel by pixel with method, one of 'mean',
+    'median', 'clip', the mean after up to iterations rounds of rejecting
+    values further than sigma standard deviations from the median, or
+    'minmax', the mean after rejecting the reject lowest and highest
+    values. The standard deviation for clipping is estimated from the
+    median absolute deviation, which a few outliers do not inflate. The
+    variance is that of the combined value, estimated from the spread of
+    the values used (times pi/2 for the median), and can be used for
+    inverse variance weights. Blocks of rows holding at most
+    memory bytes in dtype are processed at a time, which bounds the memory
+    used for uncompressed images only, compressed ones are decoded whole.
+    Both outputs have the shape of the images, channels included.
+    """
+    if method not in ('mean', 'median', 'clip', 'minmax'):
+        raise ValueError('The method must be \'mean\', \'median\', '
+                         '\'clip\' or \'minmax\'.')
+    frames = [tiff.read(path, channel=None) for path in paths]
+    count = len(frames)
+    if method == 'minmax' and count <= 2 * reject:
+        raise ValueError('At least %d images are needed to reject %d on '
+                         'either side.' % (2 * reject + 1, reject))
+    shape = frames[0].shape
+    for frame in frames:
+        if frame.shape != shape:
+            raise ValueError('The images of a group must have the same '
+                             'shape.')
+    line = count * pylab.dtype(dtype).itemsize * int(pylab.prod(shape[1:]))
+    step = max(1, memory // line)
+    image = pylab.empty(shape, dtype)
+    variance = pylab.empty(shape, dtype)
+    for start in range(0, shape[0], step):
+        block = pylab.array([frame[start:start + step] for frame in frames],
+                            dtype=dtype)
+        image[start:start + step], variance[start:start + step] = \
+            _combine(block, method, sigma, iterations, reject)
+    return image, variance
+
+def _combine(block, method, sigma, iterations, reject):
+    # Combines a (images x ...) block along the first axis.
+    count = len(block)
+    if method == 'median':
+        spread = block.var(axis=0, ddof=1) if count > 1 else 0 * block[0]
+        return pylab.median(block, axis=0), pylab.pi / 2 * spread / count
+    if method == 'minmax':
+        block = pylab.sort(block, axis=0)[reject:count - reject]
+    elif method == 'clip':
+        keep = pylab.ones(block.shape, dtype=bool)
+        for i in range(iterations):
+            values = pylab.ma.masked_array(block, ~keep)
+            centre = pylab.ma.median(values, axis=0).filled(0)
+            distance = abs(values - centre)
+            deviation = 1.4826 * pylab.ma.median(distance, axis=0).filled(0)
+            # Quantized data often has a median absolute deviation of
+            # zero, the mean absolute deviation stands in for it then.
+            deviation = pylab.where(deviation > 0, deviation,
+                                    1.2533 * distance.mean(axis=0).filled(0))
+            clipped = keep & ((abs(block - centre) <= sigma * deviation) |
+                              (deviation == 0))
+            if (clipped == keep).all():
+                break
+            keep = clipped
+        values = pylab.ma.masked_array(block, ~keep)
+        used = keep.sum(axis=0)
+        spread = values.var(axis=0, ddof=1).filled(0) \
+            if count > 1 else 0 * block[0]
+        return values.mean(axis=0).filled(0), \
+            pylab.where(used > 1, spread, 0) / pylab.maximum(used, 1)
+    used = len(block)
+    spread = block.var(axis=0, ddof=1) if used > 1 else 0 * block[0]
+    return block.mean(axis=0), spread / used
+
+def _load(path):
+    return pylab.array(tiff.read(path, channel=None))
+
+def _readahead(paths, pool, depth):
+    # The images of the paths in order, decoded on the pool at most depth
+    # ahead of the consumer.
+    pending = deque()
+    for path in paths:
+        pending.append(pool.apply_async(_load, (path,)))
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def save(path, image, dtype):
+    """ save(path, image, dtype), writes the image as a TIFF of dtype,
+    rounding and clipping to the range of integer types.
+    """
+    dtype = pylab.dtype(dtype)
+    if dtype.kind in 'ui':
+        limits = pylab.iinfo(dtype)
+        image = pylab.clip(pylab.around(image), limits.min, limits.max)
+    tiff.write(path, image.astype(dtype))
+
+def average(groups, directory, dtype=pylab.float32, threads=4, processes=1,
+            method=None, variances=False, **options):
+    """ average(groups, directory[, dtype[, threads[, processes[, method[,
+    variances]]]]], **options) -> written paths
+
+    Writes the mean of every group of an index() to directory under the
+    name of the group, with the data type of the first image of the group.
+    The means are held in dtype and decoded with threads per group, the
+    groups are spread over processes. With a method the groups are
+    combined by robust() instead, passing on the options, and with
+    variances set the variance maps of the first channel are written as
+    2D float32 images of the same name to the variance subdirectory.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if variances and not os.path.isdir(os.path.join(directory, 'variance')):
+        os.makedirs(os.path.join(directory, 'variance'))
+    if variances and method is None:
+        method = 'mean'
+    jobs = [(directory, name, paths, dtype, threads, method, variances,
+             options) for name, paths in groups.items()]
+    if processes > 1:
+        pool = Pool(processes)
+        try:
+            written = pool.map(_average, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        written = [_average(job) for job in jobs]
+    return written
+
+def _average(job):
+    directory, name, paths, dtype, threads, method, variances, options = job
+    path = os.path.join(directory, name)
+    original = tiff.read(paths[0], channel=None).dtype
+    if method is None:
+        save(path, mean(paths, dtype, threads), original)
+        return path
+    image, variance = robust(paths, method, dtype=dtype, **options)
+    save(path, image, original)
+    if variances:
+        # CollapsePlan.variance() takes 2D maps of the channel that
+        # SpectrumImage reads.
+        if variance.ndim == 3:
+            variance = variance[:, :, 0]
+        tiff.write(os.path.join(directory, 'variance', name),
+                   variance.astype(pylab.float32))
+    return path
@@ -20,6 +20,15 @@ def generate(config_path, image_paths):
     fid.close()
     return settings
 
+def read(config_path):
+    try:
+        fid = open(config_path, 'r')
+        settings = cPickle.load(fid)
+        fid.close()
+        return settings
+    except IOError:
+        return None
+
 def load(config_path):
     try:
         fid = open(config_path, 'r')
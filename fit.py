@@ -0,0 +1,182 @@
+""" Continuous least-squares fitting of synthetic spectra to measured ones.
+The rotational temperature is fitted together with the intensity scale,
+the wavelength shift and the linewidth with a Levenberg-Marquardt solver
+(scipy.optimize.leastsq). The Jacobian is analytic: the temperature
+derivative comes from the Boltzmann factors of the lines and the shift and
+linewidth derivatives from those of the line profile, so each iteration
+only costs one synthesis on the detector axis. Spectra synthesized by
+binning the lines and broadening them (see bank.templates()) are also
+supported, their shift and linewidth derivatives are taken numerically.
+"""
+
+import pylab
+from scipy import optimize
+
+import lineshape
+import spectrum
+import temperature
+
+# Parameters of Model, in the order they are passed to it.
+names = ('temperature', 'scale', 'shift', 'fwhm')
+
+class Model(object):
+    """ Synthetic spectrum of a transition on a fixed detector wavelength
+    axis, as a function of the rotational temperature, an intensity
+    scale, a shift of the line positions and the linewidth. The lines are
+    computed once, the profile matrices are kept for the last shift and
+    linewidth evaluated.
+    """
+
+    def __init__(self, istate, vi, fstate, vf, Jmax, wavelengths, linetype=1,
+                 eta=None, width=None, synthesis='direct'):
+        """ Model(istate, vi, fstate, vf, Jmax, wavelengths[, linetype[,
+        eta[, width[, synthesis]]]]), see lineshape.profiles() for the slit
+        arguments and bank.templates() for the synthesis, which must match
+        that of the templates the model refines.
+        """
+        if synthesis not in ('direct', 'convolve'):
+            raise ValueError('The synthesis must be \'direct\' or '
+                             '\'convolve\'.')
+        self.wavelengths = pylab.asarray(wavelengths, dtype=float)
+        self.lines, self.strengths, self.rotational = \
+            temperature.branches(istate, vi, fstate, vf, Jmax)
+        self.Jmax = Jmax
+        self.linetype = linetype
+        self.eta = eta
+        self.width = width
+        self.synthesis = synthesis
+        self._key = None
+        self._profiles = None
+
+    def profiles(self, shift, fwhm):
+        """ Model.profiles(shift, fwhm) -> A, dA/dshift, dA/dfwhm, the
+        sparse (lines x pixels) profile matrix and its derivatives.
+        """
+        if self._key != (shift, fwhm):
+            self._profiles = lineshape.profiles(self.lines + shift,
+                                                self.wavelengths, fwhm,
+                                                self.linetype, self.eta,
+                                                self.width, derivative=True)
+            self._key = (shift, fwhm)
+        return self._profiles
+
+    def convolved(self, I, shift, fwhm):
+        """ Model.convolved(I, shift, fwhm) -> intensities of the lines
+        binned onto the detector axis and broadened, the 'convolve'
+        synthesis of bank.templates().
+        """
+        spacing = (self.wavelengths[-1] - self.wavelengths[0]) \
+            / (len(self.wavelengths) - 1)
+        binned = spectrum.binlines(self.lines + shift, I, self.wavelengths)
+        return lineshape.broaden(binned, spacing, fwhm, self.linetype,
+                                 self.eta, self.width)
+
+    def __call__(self, Tr, scale=1.0, shift=0.0, fwhm=1e-10):
+        """ model(Tr[, scale[, shift[, fwhm]]]) -> intensities on the
+        detector axis.
+        """
+        I = temperature.populations(self.strengths, self.rotational,
+                                    self.Jmax, Tr)
+        if self.synthesis == 'convolve':
+            return scale * self.convolved(I, shift, fwhm)
+        return scale * self.profiles(shift, fwhm)[0].T.dot(I)
+
+    def jacobian(self, Tr, scale=1.0, shift=0.0, fwhm=1e-10):
+        """ Model.jacobian(Tr[, scale[, shift[, fwhm]]]) -> intensities, J
+
+        Returns the model intensities and the (pixels x 4) matrix of their
+        derivatives with respect to the parameters, in the order of names.
+        """
+        I = temperature.populations(self.strengths, self.rotational,
+                                    self.Jmax, Tr)
+        dI = temperature.dpopulations(self.strengths, self.rotational,
+                                      self.Jmax, Tr)
+        if self.synthesis == 'convolve':
+            # Binning is piecewise linear in the shift and the kernel is
+            # sampled and truncated, both are differentiated by central
+            # differences.
+            unscaled = self.convolved(I, shift, fwhm)
+            dT = self.convolved(dI, shift, fwhm)
+            step = 1e-2 * (self.wavelengths[1] - self.wavelengths[0])
+            dshift = (self.convolved(I, shift + step, fwhm) -
+                      self.convolved(I, shift - step, fwhm)) / (2 * step)
+            step = 1e-3 * fwhm
+            dfwhm = (self.convolved(I, shift, fwhm + step) -
+                     self.convolved(I, shift, fwhm - step)) / (2 * step)
+        else:
+            A, dshift, dfwhm = self.profiles(shift, fwhm)
+            unscaled = A.T.dot(I)
+            dT = A.T.dot(dI)
+            dshift = dshift.T.dot(I)
+            dfwhm = dfwhm.T.dot(I)
+        J = pylab.column_stack((scale * dT, unscaled, scale * dshift,
+                                scale * dfwhm))
+        return scale * unscaled, J
+
+class Result(object):
+    """ Outcome of fit(). The fitted values are available as attributes
+    named after the parameters, the standard errors and covariance only
+    cover the free parameters.
+    """
+
+    def __init__(self, values, free, covariance, model, residual,
+                 evaluations, success, message):
+        for name, value in zip(names, values):
+            setattr(self, name, value)
+        self.free = free
+        self.covariance = covariance
+        self.errors = {}
+        if covariance is not None:
+            for i, name in enumerate(free):
+                self.errors[name] = covariance[i, i]**0.5
+        self.model = model
+        self.residual = residual
+        self.evaluations = evaluations
+        self.success = success
+        self.message = message
+
+def fit(model, intensities, Tr, scale=1.0, shift=0.0, fwhm=1e-10, weights=None,
+        free=names):
+    """ fit(model, intensities, Tr[, scale[, shift[, fwhm[, weights[,
+    free]]]]]) -> Result
+
+    Fits the model to the measured intensities starting from the given
+    parameter values, varying only the parameters named in free. The
+    optional per-pixel weights multiply the squared residuals (inverse
+    variances for a chi-square fit). The covariance of the free parameters
+    is scaled by the reduced sum of squares of the residuals.
+    """
+    intensities = pylab.asarray(intensities, dtype=float)
+    if weights is None:
+        root = pylab.ones(len(intensities))
+    else:
+        root = pylab.asarray(weights, dtype=float)**0.5
+    initial = [float(Tr), float(scale), float(shift), float(fwhm)]
+    index = [names.index(name) for name in free]
+
+    def values(p):
+        full = list(initial)
+        for i, value in zip(index, p):
+            full[i] = value
+        return full
+
+    def residuals(p):
+        return root * (intensities - model(*values(p)))
+
+    def jacobian(p):
+        J = model.jacobian(*values(p))[1]
+        return -root[:, None] * J[:, index]
+
+    p, covariance, info, message, status = optimize.leastsq(
+        residuals, [initial[i] for i in index], Dfun=jacobian,
+        full_output=True)
+    p = pylab.atleast_1d(p)
+    full = values(p)
+    fitted = model(*full)
+    dof = len(intensities) - len(index)
+    if covariance is not None and dof > 0:
+        covariance = covariance * (info['fvec']**2).sum() / dof
+    success = status in (1, 2, 3, 4) and full[0] > 0
+    return Result(full, tuple(free), covariance, fitted,
+                  intensities - fitted, info['nfev'] + info.get('njev', 0),
+                  success, message)
@@ -0,0 +1,357 @@
+""" Line shapes and the convolution engine used to broaden spectra. The
+slit functions are sampled on the uniform wavelength grid of a spectrum
+and truncated to a few linewidths where the profile allows it, the
+convolution is then carried out directly or through FFTs depending on the
+size of the kernel. Stacks of spectra (rows x pixels) are broadened along
+the wavelength axis in a single call.
+
+Sampled kernels, and their transforms once an FFT convolution has used
+them, are kept in a bounded cache so that repeated broadening on the same
+grid with the same slit only costs the convolution itself. Besides the
+analytic profiles, a measured instrument function may be used as a slit.
+
+Alternatively the profiles of stick lines can be evaluated directly at the
+detector wavelengths, which skips the binning and convolution steps and
+does not require a uniform wavelength axis.
+"""
+
+import hashlib
+from collections import OrderedDict
+
+import pylab
+from pylab import exp, pi, log
+from scipy import ndimage, sparse
+
+# Default half-width of the truncated kernel in units of the FWHM, per
+# profile. Profiles with Lorentzian wings are not truncated by default
+# since their tails carry a significant fraction of the area.
+truncation = {1: 5.0, 2: None, 3: None}
+
+# Half-width, in units of the FWHM, of the window over which synthesize()
+# evaluates each line for the profiles that are not truncated above.
+wings = 10.0
+
+def profile(offsets, fwhm, linetype=1, eta=None):
+    """ profile(offsets, fwhm[, linetype[, eta]]) -> slit
+
+    Evaluates the slit function at the given wavelength offsets from the
+    line centre. The linetype is 1 for a Gaussian, 2 for a Lorentzian and
+    3 for a pseudo-Voigt profile, the latter requiring the Lorentzian
+    fraction eta. It may also be an Instrument, in which case the fwhm is
+    ignored and the measured response is used.
+    """
+    offsets = pylab.asarray(offsets, dtype=float)
+    if isinstance(linetype, Instrument):
+        return linetype(offsets)
+
+    elif fwhm <= 0:
+        raise ValueError('The linewidth must be positive and nonzero.')
+
+    # Gaussian
+    elif linetype == 1:
+        sigma = fwhm / (2 * log(2)**0.5)
+        return exp(-offsets**2 / (2 * sigma**2))
+
+    # Lorentzian
+    elif linetype == 2:
+        gamma = fwhm
+        return 0.5 * (gamma / (offsets**2 + 0.25 * gamma**2)) / pi
+
+    # Pseudo-Voigt
+    elif linetype == 3:
+        if eta is None:
+            raise ValueError('Eta is required for the pseudo-Voigt profile.')
+        sigma = fwhm
+        sigma_g = fwhm / (2 * log(2)**0.5)
+        g = exp(-offsets**2 / (2 * sigma_g**2)) / (sigma_g * (2 * pi)**0.5)
+        l = (0.5 * sigma / pi) / (offsets**2 + .25 * sigma**2)
+        return eta * l + (1 - eta) * g
+
+    else:
+        raise ValueError('Unsupported line type %r, use 1 (Gaussian), '
+                         '2 (Lorentzian) or 3 (pseudo-Voigt).' % (linetype,))
+
+def derivatives(offsets, fwhm, linetype=1, eta=None):
+    """ derivatives(offsets, fwhm[, linetype[, eta]]) -> doffset, dfwhm
+
+    Analytic derivatives of profile() with respect to the offset from the
+    line centre and to the fwhm. For an Instrument the offset derivative
+    is taken numerically from the measured response and the fwhm
+    derivative is zero.
+    """
+    offsets = pylab.asarray(offsets, dtype=float)
+    if isinstance(linetype, Instrument):
+        slope = pylab.gradient(linetype.response, linetype.offsets)
+        return (pylab.interp(offsets, linetype.offsets, slope, left=0.0,
+                             right=0.0), pylab.zeros(offsets.shape))
+
+    elif fwhm <= 0:
+        raise ValueError('The linewidth must be positive and nonzero.')
+
+    # Gaussian
+    elif linetype == 1:
+        sigma = fwhm / (2 * log(2)**0.5)
+        g = exp(-offsets**2 / (2 * sigma**2))
+        return -offsets / sigma**2 * g, offsets**2 / (sigma**2 * fwhm) * g
+
+    # Lorentzian
+    elif linetype == 2:
+        gamma = fwhm
+        denominator = offsets**2 + 0.25 * gamma**2
+        l = 0.5 * (gamma / denominator) / pi
+        return (-2 * offsets * l / denominator,
+                l / gamma - 0.5 * gamma * l / denominator)
+
+    # Pseudo-Voigt
+    elif linetype == 3:
+        if eta is None:
+            raise ValueError('Eta is required for the pseudo-Voigt profile.')
+        sigma = fwhm
+        sigma_g = fwhm / (2 * log(2)**0.5)
+        g = exp(-offsets**2 / (2 * sigma_g**2)) / (sigma_g * (2 * pi)**0.5)
+        denominator = offsets**2 + .25 * sigma**2
+        l = (0.5 * sigma / pi) / denominator
+        doffset = eta * (-2 * offsets * l / denominator) \
+                  + (1 - eta) * (-offsets / sigma_g**2 * g)
+        dfwhm = eta * (l / sigma - 0.5 * sigma * l / denominator) \
+                + (1 - eta) * (offsets**2 / sigma_g**2 - 1) * g / fwhm
+        return doffset, dfwhm
+
+    else:
+        raise ValueError('Unsupported line type %r, use 1 (Gaussian), '
+                         '2 (Lorentzian) or 3 (pseudo-Voigt).' % (linetype,))
+
+def kernel(spacing, length, fwhm, linetype=1, eta=None, width=None):
+    """ kernel(spacing, length, fwhm[, linetype[, eta[, width]]]) -> slit
+
+    Samples the slit function on a grid with the given spacing for a
+    spectrum of the given length. The kernel has an odd number of points
+    and is centred on its middle element. It extends to width * fwhm on
+    either side of the centre (by default the value in truncation for the
+    linetype), and never further than the length of the spectrum, which
+    covers every pair of points in it. An Instrument kernel extends over
+    the measured range of the instrument function.
+    """
+    half = length - 1
+    if isinstance(linetype, Instrument):
+        half = min(half, int(pylab.ceil(linetype.extent / spacing)))
+    else:
+        if width is None:
+            width = truncation.get(linetype)
+        if width is not None:
+            half = min(half, int(pylab.ceil(width * fwhm / spacing)))
+    offsets = pylab.arange(-half, half + 1) * spacing
+    return profile(offsets, fwhm, linetype, eta)
+
+def convolve(data, slit, method=None):
+    """ convolve(data, slit[, method]) -> convolved
+
+    Convolves data along its last axis with a centred, odd length slit,
+    returning an array of the same shape as data (the 'same' mode of
+    pylab.convolve). The method is either 'direct' or 'fft', if it is not
+    given the cheaper of the two is chosen from the sizes involved.
+    """
+    return Kernel(slit).convolve(data, method)
+
+def broaden(intensities, spacing, fwhm, linetype=1, eta=None, width=None,
+            method=None):
+    """ broaden(intensities, spacing, fwhm[, linetype[, eta[, width[,
+    method]]]]) -> broadened
+
+    Broadens a spectrum, or a (rows x pixels) stack of spectra sharing a
+    uniform wavelength grid, with the slit function of the given profile.
+    The kernel is taken from the module cache. See kernel() and convolve()
+    for the remaining arguments.
+    """
+    intensities = pylab.asarray(intensities, dtype=float)
+    slit = kernels.get(spacing, intensities.shape[-1], fwhm, linetype, eta,
+                       width)
+    return slit.convolve(intensities, method)
+
+def profiles(wavelengths, grid, fwhm, linetype=1, eta=None, width=None,
+             derivative=False):
+    """ profiles(wavelengths, grid, fwhm[, linetype[, eta[, width[,
+    derivative]]]]) -> A
+
+    Evaluates the profile of every line at the points of an ascending, not
+    necessarily uniform, wavelength grid within width * fwhm of the line
+    centre (by default the value in truncation for the linetype, or wings
+    if the profile is not truncated). Returns a sparse (lines x pixels)
+    matrix, so that a spectrum is the product of the line intensities with
+    it. If derivative is True the matrices of the profile derivatives with
+    respect to the line position and to the fwhm are returned as well.
+    """
+    wavelengths = pylab.asarray(wavelengths, dtype=float)
+    grid = pylab.asarray(grid, dtype=float)
+    if isinstance(linetype, Instrument):
+        half = linetype.extent
+    else:
+        if width is None:
+            width = truncation.get(linetype) or wings
+        half = width * fwhm
+    lower = pylab.searchsorted(grid, wavelengths - half, side='left')
+    upper = pylab.searchsorted(grid, wavelengths + half, side='right')
+    counts = upper - lower
+    lines = pylab.repeat(pylab.arange(len(wavelengths)), counts)
+    pixels = pylab.arange(counts.sum()) + \
+             pylab.repeat(lower - pylab.cumsum(counts) + counts, counts)
+    indptr = pylab.concatenate(([0], pylab.cumsum(counts)))
+    shape = (len(wavelengths), len(grid))
+    offsets = grid[pixels] - wavelengths[lines]
+    A = sparse.csr_matrix((profile(offsets, fwhm, linetype, eta), pixels,
+                           indptr), shape=shape)
+    if not derivative:
+        return A
+    doffset, dfwhm = derivatives(offsets, fwhm, linetype, eta)
+    return (A, sparse.csr_matrix((-doffset, pixels, indptr), shape=shape),
+            sparse.csr_matrix((dfwhm, pixels, indptr), shape=shape))
+
+def synthesize(wavelengths, intensities, grid, fwhm, linetype=1, eta=None,
+               width=None):
+    """ synthesize(wavelengths, intensities, grid, fwhm[, linetype[, eta[,
+    width]]]) -> broadened
+
+    Builds broadened spectra on the grid directly from stick lines, without
+    binning them onto the grid and convolving. The intensities may be 1D
+    or (rows x lines), as for spectrum.binlines(). See profiles() for the
+    remaining arguments.
+    """
+    intensities = pylab.asarray(intensities, dtype=float)
+    A = profiles(wavelengths, grid, fwhm, linetype, eta, width)
+    return A.T.dot(intensities.T).T
+
+class Kernel(object):
+    """ A sampled slit function together with its transforms, which are
+    computed the first time an FFT convolution of a given size needs them
+    and reused afterwards.
+    """
+
+    def __init__(self, slit):
+        self.slit = pylab.asarray(slit, dtype=float)
+        self._transforms = {}
+
+    def transform(self, nfft):
+        """ Kernel.transform(nfft) -> rfft of the slit zero padded to nfft.
+        """
+        try:
+            return self._transforms[nfft]
+        except KeyError:
+            self._transforms[nfft] = pylab.rfft(self.slit, nfft)
+            return self._transforms[nfft]
+
+    def convolve(self, data, method=None):
+        """ Kernel.convolve(data[, method]) -> convolved, see convolve().
+        """
+        data = pylab.asarray(data, dtype=float)
+        n = data.shape[-1]
+        half = len(self.slit) // 2
+        nfft = 2**int(pylab.ceil(pylab.log2(n + len(self.slit) - 1)))
+        if method is None:
+            method = 'direct' if len(self.slit) < 8 * pylab.log2(nfft) \
+                     else 'fft'
+
+        if method == 'direct':
+            return ndimage.convolve1d(data, self.slit, axis=-1,
+                                      mode='constant')
+        elif method == 'fft':
+            product = pylab.rfft(data, nfft, axis=-1) * self.transform(nfft)
+            return pylab.irfft(product, nfft, axis=-1)[..., half:half + n]
+        else:
+            raise ValueError('The convolution method must be \'direct\' or '
+                             '\'fft\'.')
+
+class KernelCache(object):
+    """ Least recently used cache of Kernel objects keyed by the grid
+    spacing and length together with the slit parameters. At most size
+    kernels are held, the least recently used one is evicted first.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self._kernels = OrderedDict()
+
+    def __len__(self):
+        return len(self._kernels)
+
+    def get(self, spacing, length, fwhm, linetype=1, eta=None, width=None):
+        """ KernelCache.get(spacing, length, fwhm[, linetype[, eta[,
+        width]]]) -> Kernel, returns the cached kernel for these arguments,
+        sampling it with kernel() if it is not cached yet.
+        """
+        key = (float(spacing), int(length), linetype, fwhm, eta, width)
+        try:
+            slit = self._kernels.pop(key)
+        except KeyError:
+            slit = Kernel(kernel(spacing, length, fwhm, linetype, eta, width))
+            while self._kernels and len(self._kernels) >= self.size:
+                self._kernels.popitem(last=False)
+        self._kernels[key] = slit
+        return slit
+
+    def clear(self):
+        self._kernels.clear()
+
+class Instrument(object):
+    """ A measured instrument function, such as an isolated line of a
+    calibration lamp recorded with the spectrometer, usable wherever a
+    linetype is expected. The offsets are in the units of the spectrum
+    wavelengths and the response is normalized to a unit peak.
+    """
+
+    def __init__(self, offsets, response):
+        """ Instrument(offsets, response), builds the instrument function
+        from a response sampled at offsets from the line centre.
+        """
+        offsets = pylab.asarray(offsets, dtype=float)
+        response = pylab.asarray(response, dtype=float)
+        if offsets.ndim != 1 or offsets.shape != response.shape or \
+                len(offsets) < 2:
+            raise ValueError('The offsets and response must be 1D arrays of '
+                             'the same length.')
+        order = pylab.argsort(offsets)
+        self.offsets = offsets[order]
+        self.response = response[order] / abs(response).max()
+        self.extent = abs(self.offsets).max()
+        digest = hashlib.sha1(self.offsets.tobytes())
+        digest.update(self.response.tobytes())
+        self.key = digest.hexdigest()
+
+    @classmethod
+    def fromlamp(cls, wavelengths, intensities):
+        """ Instrument.fromlamp(wavelengths, intensities) -> instrument,
+        from a recorded lamp line.
+
+        The minimum is subtracted as background and the line is centred on
+        the centroid of the points above half of its maximum.
+        """
+        wavelengths = pylab.asarray(wavelengths, dtype=float)
+        intensities = pylab.asarray(intensities, dtype=float)
+        intensities = intensities - intensities.min()
+        core = intensities >= 0.5 * intensities.max()
+        centre = (wavelengths[core] * intensities[core]).sum() \
+                 / intensities[core].sum()
+        return cls(wavelengths - centre, intensities)
+
+    @classmethod
+    def load(cls, path, delimiter=','):
+        """ Instrument.load(path[, delimiter]) -> instrument, reads a lamp
+        line from a two column (wavelength, intensity) text file.
+        """
+        data = pylab.loadtxt(path, delimiter=delimiter, ndmin=2)
+        return cls.fromlamp(data[:, 0], data[:, 1])
+
+    def __call__(self, offsets):
+        return pylab.interp(offsets, self.offsets, self.response, left=0.0,
+                            right=0.0)
+
+    def __eq__(self, other):
+        return isinstance(other, Instrument) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+# Kernel cache shared by broaden() and Spectrum.broaden().
+kernels = KernelCache()
@@ -26,9 +26,24 @@ display = True
 fwhm = 1.30e-10     # Full-width half maximum of spectral line
 profile = 3         # 1: Gaussian, 2: Lorentzian, 3: Pseudo-Voigt
 eta = 0.25          # Lorentzian fraction of pseudo-Voigt
+instrument = None   # Measured lamp line (wavelength, intensity CSV) as slit
+synthesis = 'convolve'  # 'convolve' (map + broaden) or 'direct' line profiles
+bank_dir = None     # Template bank store, defaults to ~/.rovib/templates
+bank_size = 2**30   # Size limit of the template bank store (bytes)
 temp_start = 250    # Lowest temperature to check
 temp_end = 1500     # Highest temperature to check
 step = 50           # Interval for temperature walk
+fitted = ('temperature', 'scale', 'shift', 'fwhm')  # Parameters to fit
+method = 'fit'      # 'fit' (least squares) or 'search' (bracket and refine)
+tolerance = 1.0     # Temperature tolerance of the search
+threads = 2         # Threads decoding images ahead of the analysis
+prefetch = 4        # Number of images decoded ahead of the analysis
+lazy = True         # Only read the rows of the regions from the images
+calibration = 0     # Segments of the per-frame wavelength calibration, more
+                    # than one adds a dispersion correction, 0 disables it
+result_store = None # Store of fitted results, by default
+                    # ~/.rovib/results.sqlite
+resume = True       # Reuse the stored results of unchanged frames
 
 # Dirty nasty hacks
 # TODO: add a noise detection system to filter out meaningless spectra
@@ -54,13 +69,19 @@ import Tkinter, tkFileDialog
 
 # Third Party Libraries
 import pylab
-from scipy import interpolate
 
 # Local Libraries
+import bank
+import calibrate
 import config
+import fit
+import lineshape
+import match
+import pipeline
 import read
+import results
+import search
 import spectrum
-import temperature
 
 print ('\n*************************************************\n'
          '* Analysis package for Rotational Spectra (0.1) *\n'
@@ -94,10 +115,11 @@ if top_dir is '':
     sys.exit(0)
 
 # Recursively find parsable files, allowed file types is currently hard-
-# coded in read.py. Does not check for consistency between images.
+# coded in read.py. Does not check for consistency between images. The
+# images are in natural order, which sets the time of every frame.
 image_paths = read.find_images(top_dir)
-if image_paths is None:
-    'No parsable files could be found, quitting...'
+if not image_paths:
+    print 'No parsable files could be found, quitting...'
     sys.exit(0)
 
 config_path = top_dir + '/settings.pickle'
@@ -112,70 +134,133 @@ if debug:
     debug_index = int(debug_index)
 
 
-times = range(0, len(image_paths))
-times = [dt * i for i in times]
-ctemps = []
-it = 0
-test_spectra = []
-minerrs = []
+# Slit function used for the synthetic spectra, a measured instrument
+# function replaces the Gaussian when one is given.
+slit = 1
+if instrument:
+    slit = lineshape.Instrument.load(instrument)
+
+test_spectra = None
+store = bank.TemplateBank(bank_dir, bank_size)
+
+# The template bank only provides the starting point, the temperature is
+# then fitted continuously. A measured slit has no fwhm to fit.
+test_temperatures = range(temp_start, temp_end+step, step)
+model = None
+finder = None
+calibrator = None
+if instrument:
+    fitted = [name for name in fitted if name != 'fwhm']
 
 if debug:
     image_paths = image_paths[debug_index],
 
-signal = pylab.array([])
-for image_path in image_paths:
-    print 'Image %d: ' % it,
-    exp_image = None
-    exp_image = spectrum.SpectrumImage(image_path, **settings)
-    exp_spectrum = exp_image.collapse()
-    exp_spectrum.wavelengths = exp_spectrum.wavelengths + shift
-    signal = pylab.append(signal, exp_spectrum.intensities[784])
-    if signal[-1] < noise:
+# Frames stream through the stages of pipeline.py one at a time, the
+# results are written to results.csv as they are produced.
+frames = (pipeline.Frame(i, image_path)
+          for i, image_path in enumerate(image_paths))
+
+# Results of frames whose image, settings and model are unchanged are taken
+# from the store, so an interrupted analysis resumes where it stopped.
+first = spectrum.SpectrumImage(image_paths[0], **settings).collapse()
+bank_key = store.header(istate, vi, fstate, vf, J[-1],
+                        first.wavelengths + shift, test_temperatures, fwhm,
+                        linetype=slit, synthesis=synthesis)[0]
+reduction = results.digest(settings, shift, noise, 784, calibration)
+fitting = results.digest(bank_key, method, list(fitted), tolerance)
+cache = results.ResultStore(result_store)
+stored = cache.load(reduction, fitting) if resume else {}
+frames = pipeline.lookup(frames, stored)
+
+frames = pipeline.prefetch(frames, dict(settings, lazy=lazy), threads,
+                           prefetch)
+waits = {}
+frames = pipeline.timed(frames, 'load', waits)
+frames = pipeline.collapse(frames, shift)
+frames = pipeline.prefilter(frames, noise, 784)
+
+# Every frame is written to results.csv as time, temperature, error and
+# signal, the columns of batch.py, as soon as it is done and nothing is
+# kept in memory. The plots read the results back at the end.
+resultfile = open('results.csv', 'w')
+
+def save(frame):
+    if not frame.cached:
+        cache.put(frame.key, reduction, fitting, frame.temperature,
+                  frame.error, frame.signal)
+    resultfile.write('%g, %g, %g, %g\n' % (dt * frame.index,
+                                           frame.temperature, frame.error,
+                                           frame.signal))
+    resultfile.flush()
+
+for frame in frames:
+    print 'Image %d: ' % frame.index,
+    if frame.cached:
+        print '%f K (stored)\n' % frame.temperature
+        save(frame)
+        continue
+    if frame.skipped:
         print 'Signal too low, setting to zero...\n'
-        minerrs.append(0)
-        ctemps.append(0)
-        it += 1
+        save(frame)
         continue
-    exp_spectrum = exp_spectrum.normalize()
+    exp_spectrum = frame.spectrum
     #exp_spectrum.wavelengths = 9.998381e-1 * exp_spectrum.wavelengths + 5.90766e-11
 
-    test_temperatures = range(temp_start, temp_end+step, step)
-    if not test_spectra:
-        print '\n    Generating spectra (this may take a while) ...'
-        for temp in test_temperatures:
-            test_spectrum = temperature.lines(istate, vi, fstate, vf, J[-1], temp)
-            test_spectrum = test_spectrum.map(exp_spectrum.wavelengths)
-            test_spectrum = test_spectrum.broaden(fwhm, linetype=1)
-            test_spectra.append(test_spectrum.normalize())
-
-    errors = []
-    for test_spectrum in test_spectra:
-        errors.append(pylab.sum(abs(exp_spectrum.intensities - test_spectrum.intensities)))
-
-    tck1 = interpolate.splrep(test_temperatures, errors, s=0)
-    der1 = interpolate.splev(test_temperatures, tck1, der=1)
-    tck2 = interpolate.splrep(test_temperatures, der1, s=0)
-    roots = interpolate.sproot(tck2)
-    if len(roots) is not 1:
-        print 'Temperature ambiguous, setting to zero...'
-        ctemps.append(0)
-        minerrs.append(0)
+    if test_spectra is None:
+        print '\n    Loading spectra (generating them may take a while) ...'
+        test_spectra = store.get(istate, vi, fstate, vf, J[-1],
+                                 exp_spectrum.wavelengths, test_temperatures,
+                                 fwhm, linetype=slit, synthesis=synthesis)
+
+    # The hard-coded shift is only the starting point, the remaining drift
+    # of each frame is removed by cross-correlation with the templates.
+    if calibration and calibrator is None:
+        calibrator = calibrate.Calibration(test_spectra, calibration)
+    if calibrator is not None:
+        offset, slope = calibrator(exp_spectrum.intensities)
+        exp_spectrum = spectrum.Spectrum(exp_spectrum.wavelengths,
+                                         calibrator.align(
+                                             exp_spectrum.intensities,
+                                             offset, slope))
+
+    if model is None:
+        model = fit.Model(istate, vi, fstate, vf, J[-1],
+                          exp_spectrum.wavelengths, linetype=slit,
+                          synthesis=synthesis)
+    if method == 'search':
+        if finder is None:
+            finder = search.TemperatureSearch(
+                lambda temp: model(temp, 1.0, 0.0, fwhm), test_temperatures,
+                test_spectra, tolerance)
+        temp, error = finder(exp_spectrum.intensities)
+        matched = spectrum.Spectrum(exp_spectrum.wavelengths,
+                                    finder.spectrum(temp))
+        frame.error = sum((exp_spectrum.intensities
+                           - matched.intensities)**2)
+        frame.temperature = temp
     else:
-        matched = temperature.lines(istate, vi, fstate, vf, J[-1], roots[-1])
-        #matched.inair()
-        matched = matched.map(exp_spectrum.wavelengths)
-        matched = matched.broaden(fwhm, linetype=1)
-        matched = matched.normalize()
-        minerrs.append(sum((exp_spectrum.intensities - matched.intensities)**2))
-        ctemps.append(roots)
-    print '%f K\n (surface error of %f)' % (ctemps[-1], minerrs[-1])
+        errors = match.errors(exp_spectrum.intensities, test_spectra)
+        start = test_temperatures[pylab.argmin(errors)]
+        scale = 1 / model(start, 1.0, 0.0, fwhm).max()
+        result = fit.fit(model, exp_spectrum.intensities, start, scale, 0.0,
+                         fwhm, free=fitted)
+        if not result.success:
+            print 'Fit did not converge, setting to zero...'
+        else:
+            matched = spectrum.Spectrum(exp_spectrum.wavelengths,
+                                        result.model)
+            #matched.inair()
+            frame.error = sum(result.residual**2)
+            frame.temperature = result.temperature
+    print '%f K\n (surface error of %f)' % (frame.temperature, frame.error)
+    save(frame)
 
     if debug:
         pylab.clf()
         exp_spectrum.show()
         matched.show()
         pylab.legend(['Experimental', 'Simulated'])
-        print 'Error in simulation:', minerrs[-1]
+        print 'Error in simulation:', frame.error
         pylab.plot(exp_spectrum.wavelengths, exp_spectrum.intensities-matched.intensities)
         pylab.title('Differences')
         specfile = open('measured.csv', 'w')
@@ -186,17 +271,14 @@ for image_path in image_paths:
             matchfile.write('%g, %g\n' % (wavelength, matched[wavelength]))
         specfile.close()
         matchfile.close()
-
-    it += 1
+resultfile.close()
+cache.close()
+print 'Waited %.2f s on loading images' % waits['load']
 
 if display:
-    fid = open('results.csv', 'w')
-
-    for i in range(len(ctemps)):
-        fid.write('%g, %g\n' % (times[i], ctemps[i]))
-
-    fid.close()
-
+    times, ctemps, minerrs, signal = pylab.loadtxt('results.csv',
+                                                   delimiter=',',
+                                                   ndmin=2).T
     pylab.plot(times, ctemps)
     signal = signal/signal.max()
     signal = signal*max(ctemps)
@@ -0,0 +1,73 @@
+""" Spatially resolved temperatures along the slit. Instead of averaging all
+lines of the data regions, every line, or bin of lines, is collapsed into
+its own spectrum (see spectrum.CollapsePlan.rows()) and all of them are
+fitted together. The fit is vectorized over the spectra: the coarse
+estimate comes from one product with the template matrix, the refinement
+either interpolates the template errors or runs Gauss-Newton steps on the
+reduced basis surrogate for all spectra at once.
+"""
+
+import pylab
+
+import match
+
+def fit(spectra, temperatures, templates, surrogate=None, iterations=10,
+        tolerance=0.1):
+    """ fit(spectra, temperatures, templates[, surrogate[, iterations[,
+    tolerance]]]) -> temperatures, scales, errors
+
+    Fits the temperature of every spectrum of a (... x pixels) array
+    against the (temperatures x pixels) templates, normalized to a
+    maximum of one. Without a surrogate the minimum of the squared error
+    is interpolated between the grid points. With a surrogate.Surrogate
+    of the same templates the temperature and intensity scale are refined
+    by at most iterations Gauss-Newton steps, stopping once no temperature
+    moves by more than tolerance (K). The outputs have the leading shape
+    of the spectra, the errors are the sums of squared residuals of the
+    normalized spectra.
+    """
+    spectra = pylab.asarray(spectra, dtype=float)
+    temperatures = pylab.asarray(temperatures, dtype=float)
+    shape = spectra.shape[:-1]
+    measured = spectra.reshape(-1, spectra.shape[-1])
+    norm = abs(measured).max(axis=1)
+    norm[norm == 0] = 1
+    measured = measured / norm[:, None]
+
+    errors = match.errors(measured, templates, 'l2')
+    best = pylab.argmin(errors, axis=1)
+    count = len(measured)
+    if surrogate is None:
+        # Parabola through the smallest error and its neighbours.
+        centre = pylab.clip(best, 1, len(temperatures) - 2)
+        rows = pylab.arange(count)
+        e0, e1, e2 = [errors[rows, centre + i] for i in (-1, 0, 1)]
+        curvature = e0 - 2 * e1 + e2
+        offset = pylab.zeros(count)
+        valid = curvature > 0
+        offset[valid] = 0.5 * (e0 - e2)[valid] / curvature[valid]
+        index = pylab.clip(centre + pylab.clip(offset, -1, 1), 0,
+                           len(temperatures) - 1)
+        output = pylab.interp(index, pylab.arange(len(temperatures)),
+                              temperatures)
+        scales = pylab.ones(count)
+        residuals = errors[rows, best]
+    else:
+        output = temperatures[best]
+        for i in range(iterations):
+            model = surrogate(output)
+            scales = (measured * model).sum(axis=1) / (model**2).sum(axis=1)
+            residual = measured - scales[:, None] * model
+            J = scales[:, None] * surrogate.derivative(output)
+            step = (J * residual).sum(axis=1) / (J**2).sum(axis=1)
+            step[~pylab.isfinite(step)] = 0
+            previous = output
+            output = pylab.clip(output + step, temperatures[0],
+                                temperatures[-1])
+            if abs(output - previous).max() <= tolerance:
+                break
+        model = surrogate(output)
+        scales = (measured * model).sum(axis=1) / (model**2).sum(axis=1)
+        residuals = ((measured - scales[:, None] * model)**2).sum(axis=1)
+    return (output.reshape(shape), scales.reshape(shape),
+            residuals.reshape(shape))
@@ -0,0 +1,77 @@
+""" Scoring of measured spectra against a template bank. A normalized
+frame, or a (frames x pixels) stack of them, is compared with every row of
+a (temperatures x pixels) template matrix at once. The squared error
+metrics reduce to a single matrix product, the absolute error is evaluated
+by broadcasting over blocks of frames so that memory stays bounded.
+"""
+
+import pylab
+
+# Upper bound on the number of elements of the (frames x templates x
+# pixels) difference array evaluated at once for the absolute error.
+block = 2**22
+
+def window(wavelengths, start=None, end=None):
+    """ window(wavelengths[, start[, end]]) -> mask, selects the pixels
+    with start <= wavelength <= end, either bound may be omitted.
+    """
+    wavelengths = pylab.asarray(wavelengths, dtype=float)
+    mask = pylab.ones(wavelengths.shape, dtype=bool)
+    if start is not None:
+        mask &= wavelengths >= start
+    if end is not None:
+        mask &= wavelengths <= end
+    return mask
+
+def errors(frames, templates, metric='l1', weights=None, mask=None):
+    """ errors(frames, templates[, metric[, weights[, mask]]]) -> errors
+
+    Returns the error of every frame against every template, a 1D array
+    over the templates for a single frame or a (frames x templates) array
+    for a stack. The metric is 'l1', the sum of absolute differences,
+    'l2', the sum of squared differences, or 'chi2', the l2 error with the
+    weights being the inverse variance of each pixel. The weights are
+    per pixel, or per frame and pixel for a stack. The mask, for example
+    from window(), restricts the comparison to the selected pixels.
+    """
+    frames = pylab.asarray(frames, dtype=float)
+    templates = pylab.asarray(templates)
+    single = frames.ndim == 1
+    frames = pylab.atleast_2d(frames)
+    if weights is not None:
+        weights = pylab.atleast_2d(pylab.asarray(weights, dtype=float))
+    if mask is not None:
+        frames = frames[:, mask]
+        templates = templates[:, mask]
+        if weights is not None:
+            weights = weights[:, mask]
+    if frames.shape[-1] != templates.shape[-1]:
+        raise ValueError('The frames and templates must have the same '
+                         'number of pixels.')
+
+    if metric == 'l1':
+        output = pylab.empty((len(frames), len(templates)))
+        step = max(1, block // max(1, templates.size))
+        for i in range(0, len(frames), step):
+            difference = abs(frames[i:i + step, None, :] - templates[None])
+            if weights is not None:
+                w = weights if len(weights) == 1 else weights[i:i + step]
+                difference *= w[:, None, :]
+            output[i:i + step] = difference.sum(axis=-1)
+    elif metric in ('l2', 'chi2'):
+        if weights is None and metric == 'chi2':
+            raise ValueError('The chi-square requires inverse variance '
+                             'weights.')
+        elif weights is None:
+            weights = pylab.ones((1, frames.shape[-1]))
+        # sum w (x - t)^2 = sum w x^2 - 2 sum w x t + sum w t^2
+        output = (weights * frames**2).sum(axis=-1)[:, None] \
+                 - 2 * pylab.dot(weights * frames, templates.T) \
+                 + pylab.dot(weights, (templates**2).T)
+        output = pylab.maximum(output, 0)
+    else:
+        raise ValueError('The metric must be \'l1\', \'l2\' or \'chi2\'.')
+
+    if single:
+        return output[0]
+    return output
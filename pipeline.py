@@ -0,0 +1,314 @@
+""" Streaming stages of the frame analysis. Each stage is a generator that
+takes an iterable of Frame objects, does its part of the work on each of
+them and yields them on, so that stages compose into a pipeline
+
+    discover -> load -> collapse -> prefilter -> fit -> sink
+
+through which frames flow one at a time. Nothing is accumulated along the
+way, a run over any number of frames uses constant memory and whatever
+consumes the end of the pipeline sees the results as they are produced.
+
+Reading and decoding images mostly waits on the disk, prefetch() replaces
+load() with a read-ahead on a thread pool so that the next images are
+decoded while the current one is fitted. Wrapping any stage in timed()
+records how long its consumer waited on it. Frames with a stored result
+are marked by lookup() and passed through the other stages untouched, in
+their place, record() stores the results of the others. For temperatures
+resolved along the slit collapse() also bins the lines of every image,
+resolve() fits them and sinkmap() writes the resulting rows of the map.
+Frames are aligned with the wavelength axis of the templates by
+calibrate().
+"""
+
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import pylab
+
+import fit as fitting
+import maps
+import match
+import read
+import results
+import spectrum
+
+class Frame(object):
+    """ A single image and everything derived from it on its way through
+    the pipeline. The temperature and error stay zero for frames that are
+    skipped or fail to fit. Cached frames carry a stored result and are
+    left alone by every stage.
+    """
+
+    def __init__(self, index, path):
+        self.index = index
+        self.path = path
+        self.image = None
+        self.spectrum = None
+        self.signal = None
+        self.skipped = False
+        self.temperature = 0.0
+        self.error = 0.0
+        self.rows = None
+        self.temperatures = None
+        self.offset = 0.0
+        self.slope = 0.0
+        self.key = None
+        self.cached = False
+
+class Fitter(object):
+    """ Fits normalized spectra, starting from the best matching template
+    of a bank and refining with fit.fit(). The model is built from the
+    wavelength axis of the first spectrum. A warm fitter starts from the
+    last successful result instead, frames of a time series being close.
+    The slit and synthesis must be those the templates were built with.
+    """
+
+    def __init__(self, templates, temperatures, istate, vi, fstate, vf, Jmax,
+                 fwhm, linetype=1, free=fitting.names, warm=False, eta=None,
+                 synthesis='direct'):
+        self.templates = templates
+        self.temperatures = pylab.asarray(temperatures, dtype=float)
+        self.transition = (istate, vi, fstate, vf, Jmax)
+        self.fwhm = fwhm
+        self.linetype = linetype
+        self.eta = eta
+        self.synthesis = synthesis
+        self.free = free
+        self.warm = warm
+        self.previous = None
+        self.model = None
+
+    def __call__(self, measured):
+        """ fitter(measured) -> Result, or None if the fit fails.
+        """
+        if self.model is None:
+            self.model = fitting.Model(*(self.transition +
+                                         (measured.wavelengths,
+                                          self.linetype, self.eta)),
+                                       synthesis=self.synthesis)
+        if self.warm and self.previous is not None:
+            start = self.previous
+        else:
+            errors = match.errors(measured.intensities, self.templates)
+            start = self.temperatures[pylab.argmin(errors)]
+        scale = 1 / self.model(start, 1.0, 0.0, self.fwhm).max()
+        result = fitting.fit(self.model, measured.intensities, start, scale,
+                             0.0, self.fwhm, free=self.free)
+        if result.success:
+            self.previous = result.temperature
+            return result
+        self.previous = None
+        return None
+
+def discover(directory):
+    """ Yields a Frame for every image found under directory, in natural
+    order, as the cached directory index lists them.
+    """
+    for index, path in enumerate(read.Index(directory).images()):
+        yield Frame(index, path)
+
+def lookup(frames, stored, content=False):
+    """ Sets the key of every frame (see results.identify()) and looks it
+    up in stored, a dict from ResultStore.load(). Frames with a stored
+    result get it and are marked as cached, the later stages pass them on
+    as they are.
+    """
+    for frame in frames:
+        frame.key = results.identify(frame.path, content)
+        hit = stored.get(frame.key)
+        if hit is not None:
+            frame.temperature, frame.error, frame.signal, temperatures = hit
+            if temperatures is not None:
+                frame.temperatures = pylab.array(temperatures)
+            frame.cached = True
+        yield frame
+
+def record(frames, store, settings, model):
+    """ Stores the result of every frame that was not found by lookup() in
+    store, a ResultStore, under the settings and model hashes.
+    """
+    for frame in frames:
+        if not frame.cached:
+            store.put(frame.key, settings, model, frame.temperature,
+                      frame.error, frame.signal, frame.temperatures)
+        yield frame
+
+def load(frames, settings):
+    """ Reads the image of every frame as a SpectrumImage configured with
+    settings.
+    """
+    for frame in frames:
+        if not frame.cached:
+            frame.image = spectrum.SpectrumImage(frame.path, **settings)
+        yield frame
+
+def prefetch(frames, settings, threads=2, depth=4):
+    """ Like load(), but reads the images on a pool of threads, at most
+    depth frames ahead of the consumer.
+    """
+    pool = ThreadPool(threads)
+    try:
+        for frame in parallel(frames, _Loader(settings), pool, depth):
+            yield frame
+    finally:
+        pool.terminate()
+
+class _Loader(object):
+    # Loads the image of a single frame, the function run by prefetch().
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def __call__(self, frame):
+        if not frame.cached:
+            frame.image = spectrum.SpectrumImage(frame.path, **self.settings)
+        return frame
+
+def collapse(frames, shift=0.0, binning=None):
+    """ Collapses the image of every frame to a spectrum, shifting the
+    wavelengths by shift, and releases the image. The collapse plan is
+    compiled from the first image and only recompiled if the shape of the
+    images changes. With binning, the lines of the data regions are also
+    collapsed in bins of that many lines into the rows of the frame.
+    """
+    plan = None
+    for frame in frames:
+        if frame.cached:
+            yield frame
+            continue
+        image = frame.image
+        if plan is None or plan.shape != image.image.shape[:2]:
+            plan = spectrum.CollapsePlan.fromimage(image)
+            wavelengths = plan.wavelengths + shift
+        frame.spectrum = spectrum.Spectrum(wavelengths, plan(image.image))
+        if binning:
+            frame.rows = plan.rows(image.image, binning)
+        frame.image = None
+        yield frame
+
+def prefilter(frames, noise, pixel):
+    """ Takes the intensity at pixel as the signal of every frame. Frames
+    with a signal below noise are marked as skipped, the spectra of the
+    others are normalized.
+    """
+    for frame in frames:
+        if frame.cached:
+            yield frame
+            continue
+        frame.signal = frame.spectrum.intensities[pixel]
+        if frame.signal < noise:
+            frame.skipped = True
+        else:
+            frame.spectrum = frame.spectrum.normalize()
+        yield frame
+
+def fit(frames, fitter):
+    """ Fits the spectrum of every frame that is not skipped with fitter,
+    a Fitter or any callable returning a fit.Result or None.
+    """
+    for frame in frames:
+        if not frame.skipped and not frame.cached:
+            result = fitter(frame.spectrum)
+            if result is not None:
+                frame.temperature = result.temperature
+                frame.error = (result.residual**2).sum()
+        yield frame
+
+def calibrate(frames, calibration):
+    """ Estimates the shift and dispersion of every frame that is not
+    skipped with calibration, a calibrate.Calibration, and resamples its
+    spectrum and rows onto the axis of the reference.
+    """
+    for frame in frames:
+        if not frame.skipped and not frame.cached:
+            intensities = frame.spectrum.intensities
+            frame.offset, frame.slope = calibration(intensities)
+            frame.spectrum = spectrum.Spectrum(
+                frame.spectrum.wavelengths,
+                calibration.align(intensities, frame.offset, frame.slope))
+            if frame.rows is not None:
+                frame.rows = calibration.align(frame.rows, frame.offset,
+                                               frame.slope)
+        yield frame
+
+def resolve(frames, templates, temperatures, noise, pixel, surrogate=None):
+    """ Fits the rows of every frame with maps.fit() and stores the
+    temperatures along the slit. Rows with an intensity at pixel below
+    noise are set to zero, as is the whole map of a skipped frame.
+    """
+    for frame in frames:
+        if frame.rows is not None:
+            fitted = maps.fit(frame.rows, temperatures, templates,
+                              surrogate)[0]
+            fitted[frame.rows[:, pixel] < noise] = 0
+            if frame.skipped:
+                fitted[:] = 0
+            frame.temperatures = fitted
+            frame.rows = None
+        yield frame
+
+def parallel(frames, function, pool, depth):
+    """ Applies function to the frames, or any other items, on a process
+    or thread pool and yields the results in their original order. Cached
+    frames are passed on in their place without being sent to the pool.
+    At most depth items are in flight at any time.
+    """
+    pending = deque()
+    for frame in frames:
+        if getattr(frame, 'cached', False):
+            pending.append(frame)
+        else:
+            pending.append(pool.apply_async(function, (frame,)))
+        if len(pending) >= depth:
+            yield _result(pending.popleft())
+    while pending:
+        yield _result(pending.popleft())
+
+def _result(pending):
+    # The frame of an entry of parallel(), waiting for it if it is in flight.
+    if getattr(pending, 'cached', False):
+        return pending
+    return pending.get()
+
+def timed(frames, name, waits):
+    """ Passes the frames on unchanged, adding the time spent waiting for
+    each of them to waits[name] (seconds). The wait includes the work of
+    all stages upstream that is not overlapped with the consumer, so the
+    difference between two timed points is the cost of the stages between
+    them.
+    """
+    waits.setdefault(name, 0.0)
+    frames = iter(frames)
+    while True:
+        start = time.time()
+        try:
+            frame = next(frames)
+        except StopIteration:
+            return
+        waits[name] += time.time() - start
+        yield frame
+
+def sink(frames, fid, dt, paths=False):
+    """ Writes time, temperature, error and signal of every frame as a line
+    of CSV to the open file fid as soon as the frame arrives, and yields
+    the frame on. With paths, the path of the image ends the line.
+    """
+    for frame in frames:
+        line = '%g, %g, %g, %g' % (dt * frame.index, frame.temperature,
+                                   frame.error, frame.signal)
+        if paths:
+            line += ', ' + frame.path
+        fid.write(line + '\n')
+        fid.flush()
+        yield frame
+
+def sinkmap(frames, fid, dt):
+    """ Writes the time and the temperatures along the slit of every frame
+    as a line of CSV to the open file fid, like sink().
+    """
+    for frame in frames:
+        fid.write(', '.join(['%g' % (dt * frame.index)] +
+                            ['%g' % Tr for Tr in frame.temperatures]) + '\n')
+        fid.flush()
+        yield frame
@@ -1,17 +1,194 @@
+""" Discovery of the images of an acquisition. Archive trees can hold
+hundreds of thousands of files, so the listing of every directory is kept
+in a manifest together with its modification time, and later runs only
+list the directories whose time changed (a file was added, removed or
+renamed). File systems store modification times with a coarse
+granularity, a change made in the same tick as a listing does not change
+the time, so a directory modified within granularity seconds of its last
+listing is listed again. Only names are kept, the size and modification
+time of an image are always taken from the file itself. Images are
+returned in natural order, frame 10 after frame 9, independent of the
+order of the file system.
+"""
+
+import hashlib
+import json
 import os
+import re
+import stat
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+supported_types = ('.tif', '.tiff')
+
+# Bumped whenever the layout of the manifest changes.
+version = 2
+
+# Seconds by which a modification time may lag the change (2 on FAT).
+granularity = 2.0
+
+def natural(text):
+    """ natural(text) -> key sorting the numbers in text by value.
+    """
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'(\d+)', text)]
+
+def frame(name):
+    """ frame(name) -> the last number in name, or None.
+    """
+    numbers = re.findall(r'\d+', os.path.splitext(name)[0])
+    if numbers:
+        return int(numbers[-1])
+    return None
+
+def _listing(directory):
+    # Names of the images and subdirectories of a directory.
+    files = []
+    subdirs = []
+    if scandir is not None:
+        for entry in scandir(directory):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif os.path.splitext(entry.name)[1] in supported_types:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(directory):
+            info = os.lstat(os.path.join(directory, name))
+            if stat.S_ISDIR(info.st_mode):
+                subdirs.append(name)
+            elif os.path.splitext(name)[1] in supported_types:
+                files.append(name)
+    return files, subdirs
+
+def _entries(directory):
+    # Natural order listing of a directory as stored in the manifest,
+    # [name] for a subdirectory and [name, frame] for an image.
+    files, subdirs = _listing(directory)
+    entries = [[name, frame(name)] for name in files]
+    entries += [[name] for name in subdirs]
+    entries.sort(key=lambda entry: (natural(entry[0]), entry[0]))
+    return entries
+
+class Index(object):
+    """ Cached listing of the images under a directory. The manifest holds,
+    for every directory, its modification time, the time it was listed and
+    its subdirectories and images in natural order, the latter with their
+    frame number.
+    """
+
+    def __init__(self, root=None, manifest=None):
+        """ Index([root[, manifest]]), the manifest is stored by default in
+        ~/.rovib/index under a hash of the absolute path of root.
+        """
+        if not root:
+            root = '.'
+        if manifest is None:
+            digest = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()
+            manifest = os.path.join(os.path.expanduser('~'), '.rovib',
+                                    'index', digest + '.json')
+        self.root = root
+        self.manifest = manifest
+        self.directories = {}
+        try:
+            with open(manifest, 'r') as fid:
+                stored = json.load(fid)
+            if stored.get('version') == version and \
+                    stored.get('root') == os.path.abspath(root):
+                self.directories = stored['directories']
+        except (IOError, OSError, ValueError):
+            pass
+
+    def entries(self, after=None):
+        """ Index.entries([after]) -> generator of (path, frame) for every
+        image, in natural order. Directories are only listed if their
+        modification time differs from the manifest or lies within
+        granularity of their last listing. The manifest is updated once
+        all entries have been generated.
+
+        With after, the path of an image, only the images after it are
+        generated and directories sorting before it are not visited.
+        """
+        bound = None
+        directories = {}
+        if after is not None:
+            relative = os.path.relpath(after, self.root)
+            bound = [(natural(part), part)
+                     for part in relative.split(os.sep)]
+            # The directories that are not visited keep their listing.
+            directories.update(self.directories)
+        for entry in self._visit('', directories, bound):
+            yield entry
+        if directories != self.directories:
+            self.directories = directories
+            self.save()
+
+    def images(self):
+        """ Index.images() -> generator of the image paths in natural
+        order, see entries().
+        """
+        for entry in self.entries():
+            yield entry[0]
+
+    def _visit(self, relative, directories, bound=None):
+        directory = os.path.join(self.root, relative) if relative \
+            else self.root
+        try:
+            mtime = os.stat(directory).st_mtime
+            cached = self.directories.get(relative)
+            if cached is None or cached['mtime'] != mtime or \
+                    mtime + granularity > cached['listed']:
+                cached = {'mtime': mtime, 'listed': time.time(),
+                          'entries': _entries(directory)}
+        except OSError:
+            return
+        directories[relative] = cached
+
+        prefix = os.path.join(directory, '')
+        for entry in cached['entries']:
+            below = None
+            if bound:
+                key = (natural(entry[0]), entry[0])
+                if key < bound[0] or key == bound[0] and len(entry) > 1:
+                    continue
+                if key == bound[0]:
+                    below = bound[1:]
+            if len(entry) == 1:
+                for image in self._visit(os.path.join(relative, entry[0]),
+                                         directories, below):
+                    yield image
+            else:
+                yield (prefix + entry[0],) + tuple(entry[1:])
+
+    def save(self):
+        """ Writes the manifest through a temporary file renamed into
+        place. A manifest that cannot be written is silently skipped, the
+        next run lists the directories again.
+        """
+        folder = os.path.dirname(self.manifest)
+        temporary = '%s.%d.tmp' % (self.manifest, os.getpid())
+        try:
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            with open(temporary, 'w') as fid:
+                json.dump({'version': version,
+                           'root': os.path.abspath(self.root),
+                           'directories': self.directories}, fid)
+            os.rename(temporary, self.manifest)
+        except (IOError, OSError):
+            pass
 
 def find_images(path=None):
     """
-    Detects images in the provided 'path' and returns a list of
-    lists in the form [['path1', 'file1'], ['path2', 'file2'], ...].
+    Detects images in the provided 'path' and returns a list of their
+    paths, ['path1/file1', 'path2/file2', ...], in natural order. The
+    directory listings are cached, see Index.
 
     """
-    if not path:
-        path = '.'
-    supported_types = ['.tif', '.tiff']
-    images = []
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            if os.path.splitext(file)[1] in supported_types:
-                images.append(root + '/' + file)
-    return images
+    return list(Index(path).images())
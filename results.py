@@ -0,0 +1,121 @@
+""" Content addressed store of fitted results, so that an interrupted run
+resumes where it stopped and a rerun only fits the frames whose inputs
+changed. Every result is keyed by three hashes: of the image (its size and
+modification time, or optionally its content), of the settings reducing
+it to a spectrum and of the model fitted to it. A change of the model
+invalidates every frame, a new image only itself. The store is an SQLite
+database, all results of a settings and model pair are read in one query
+so that checking a run of 100k frames costs a single table scan.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+def digest(*items):
+    """ digest(*items) -> hex SHA-1 of the JSON of the items, which must
+    be JSON serializable (numpy scalars and arrays are converted).
+    """
+    return hashlib.sha1(json.dumps(items, sort_keys=True,
+                                   default=_plain).encode()).hexdigest()
+
+def _plain(item):
+    try:
+        return item.tolist()
+    except AttributeError:
+        raise TypeError('%r cannot be hashed.' % (item,))
+
+def identify(path, content=False):
+    """ identify(path[, content]) -> key of the image
+
+    The key combines the name, size and modification time of the file, a
+    single stat. With content set the file is hashed instead, which
+    survives copies and touches but reads every byte.
+    """
+    if content:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as fid:
+            for block in iter(lambda: fid.read(2**20), b''):
+                sha.update(block)
+        return 'sha1:' + sha.hexdigest()
+    info = os.stat(path)
+    return 'stat:%d:%r:%s' % (info.st_size, info.st_mtime,
+                              os.path.basename(path))
+
+class ResultStore(object):
+    """ Results of fitted frames in an SQLite database. Writes are
+    committed in batches, every interval seconds, so a crash loses at most
+    the results of the last interval.
+    """
+
+    def __init__(self, path=None, interval=1.0):
+        """ ResultStore([path[, interval]]), opens (and creates) the
+        database, by default ~/.rovib/results.sqlite.
+        """
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.rovib',
+                                'results.sqlite')
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.path = path
+        self.interval = interval
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS results (image TEXT, settings TEXT, '
+            'model TEXT, temperature REAL, error REAL, signal REAL, map TEXT, '
+            'created REAL, PRIMARY KEY (settings, model, image))')
+        self.connection.commit()
+        self.last = time.time()
+
+    def load(self, settings, model):
+        """ ResultStore.load(settings, model) -> dict of image key:
+        (temperature, error, signal, temperatures) for every stored result
+        of the settings and model hashes. The temperatures along the slit
+        are None or a list.
+        """
+        rows = self.connection.execute(
+            'SELECT image, temperature, error, signal, map FROM results '
+            'WHERE settings = ? AND model = ?', (settings, model))
+        return dict((image, (temperature, error, signal,
+                             json.loads(along) if along else None))
+                    for image, temperature, error, signal, along in rows)
+
+    def put(self, image, settings, model, temperature, error, signal,
+            temperatures=None):
+        """ ResultStore.put(image, settings, model, temperature, error,
+        signal[, temperatures]), stores a result, with the temperatures
+        along the slit if there are any, replacing any with the same keys.
+        """
+        if temperatures is not None:
+            temperatures = json.dumps([float(value)
+                                       for value in temperatures])
+        self.connection.execute(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (image, settings, model, float(temperature), float(error),
+             float(signal), temperatures, time.time()))
+        if time.time() - self.last > self.interval:
+            self.flush()
+
+    def flush(self):
+        """ Commits the pending results.
+        """
+        self.connection.commit()
+        self.last = time.time()
+
+    def prune(self, settings, model):
+        """ ResultStore.prune(settings, model) -> number of results removed
+        that belong to any other settings or model.
+        """
+        cursor = self.connection.execute(
+            'DELETE FROM results WHERE settings != ? OR model != ?',
+            (settings, model))
+        self.flush()
+        return cursor.rowcount
+
+    def close(self):
+        self.flush()
+        self.connection.close()
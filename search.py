@@ -0,0 +1,131 @@
+""" Adaptive search for the temperature of the synthetic spectrum that best
+matches a measured one. The minimum of the error is bracketed on a coarse
+temperature grid and then refined by bounded Brent minimization to the
+requested tolerance. Consecutive frames of a time series have similar
+temperatures, so each search starts from a narrow bracket around the
+previous result and only falls back to the coarse grid when that bracket
+does not contain a minimum. Synthesized spectra are memoized by
+temperature, rounded to a tenth of the tolerance so that the points of a
+warm start around a steady temperature are revisited, and those cost
+nothing.
+"""
+
+from collections import OrderedDict
+
+import pylab
+from scipy import optimize
+
+import match
+
+class TemperatureSearch(object):
+    """ Coarse-to-fine temperature search with warm starts. The spectra are
+    produced by synthesize, a function of the temperature returning
+    intensities on the detector axis, and normalized to a maximum of one
+    before being compared with the frames.
+    """
+
+    def __init__(self, synthesize, temperatures, templates=None,
+                 tolerance=1.0, span=None, metric='l1', weights=None,
+                 mask=None, size=1024):
+        """ TemperatureSearch(synthesize, temperatures[, templates[,
+        tolerance[, span[, metric[, weights[, mask[, size]]]]]]])
+
+        The temperatures form the ascending coarse grid, if the matching
+        (temperatures x pixels) templates are given the coarse errors are
+        computed from them in one call. The result is refined to within
+        tolerance (K). A warm start brackets the previous result by span
+        on either side, by default the coarse grid spacing. The metric,
+        weights and mask are passed on to match.errors(). At most size
+        spectra are memoized, the least recently used are dropped first.
+        Spectra are synthesized at temperatures rounded to a tenth of the
+        tolerance.
+        """
+        self.synthesize = synthesize
+        self.temperatures = pylab.asarray(temperatures, dtype=float)
+        self.templates = templates
+        self.tolerance = tolerance
+        if span is None:
+            span = pylab.diff(self.temperatures).max()
+        self.span = span
+        self.metric = metric
+        self.weights = weights
+        self.mask = mask
+        self.size = size
+        self.previous = None
+        self.evaluations = 0
+        self._spectra = OrderedDict()
+
+    def spectrum(self, Tr):
+        """ TemperatureSearch.spectrum(Tr) -> normalized spectrum at Tr,
+        rounded to a tenth of the tolerance, synthesized only if it is not
+        memoized.
+        """
+        Tr = float(Tr)
+        if self.tolerance > 0:
+            resolution = 0.1 * self.tolerance
+            Tr = round(Tr / resolution) * resolution
+        try:
+            output = self._spectra.pop(Tr)
+        except KeyError:
+            output = pylab.asarray(self.synthesize(Tr), dtype=float)
+            output = output / abs(output).max()
+            self.evaluations += 1
+            while self._spectra and len(self._spectra) >= self.size:
+                self._spectra.popitem(last=False)
+        self._spectra[Tr] = output
+        return output
+
+    def error(self, intensities, Tr):
+        """ TemperatureSearch.error(intensities, Tr) -> error of the frame
+        against the spectrum at Tr.
+        """
+        return match.errors(intensities, self.spectrum(Tr)[None],
+                            self.metric, self.weights, self.mask)[0]
+
+    def bracket(self, intensities):
+        """ TemperatureSearch.bracket(intensities) -> (lower, upper)
+
+        Evaluates the frame on the coarse grid and returns the grid points
+        on either side of the smallest error. A minimum on the edge of the
+        grid is returned as a bracket of zero width on that edge.
+        """
+        if self.templates is not None:
+            errors = match.errors(intensities, self.templates, self.metric,
+                                  self.weights, self.mask)
+        else:
+            errors = [self.error(intensities, Tr) for Tr in self.temperatures]
+        best = int(pylab.argmin(errors))
+        if best == 0 or best == len(self.temperatures) - 1:
+            return self.temperatures[best], self.temperatures[best]
+        return self.temperatures[best - 1], self.temperatures[best + 1]
+
+    def __call__(self, intensities):
+        """ search(intensities) -> temperature, error
+
+        Finds the temperature of the best matching spectrum for a frame,
+        warm starting from the result of the previous call.
+        """
+        lower = upper = None
+        if self.previous is not None:
+            lower = max(self.previous - self.span, self.temperatures[0])
+            upper = min(self.previous + self.span, self.temperatures[-1])
+            centre = self.error(intensities, self.previous)
+            if self.error(intensities, lower) < centre or \
+                    self.error(intensities, upper) < centre:
+                lower = upper = None
+        if lower is None:
+            lower, upper = self.bracket(intensities)
+
+        if upper > lower:
+            Tr = optimize.fminbound(lambda Tr: self.error(intensities, Tr),
+                                    lower, upper, xtol=self.tolerance)
+        else:
+            Tr = lower
+        Tr = float(Tr)
+        self.previous = Tr
+        return Tr, self.error(intensities, Tr)
+
+    def reset(self):
+        """ Forgets the previous result, the next search is a full one.
+        """
+        self.previous = None
@@ -3,14 +3,16 @@ an arbitrary number of sets containing wavelength and intensity data. It
 also features a number of helper functions for displaying, adding and
 subtracting spectra. The second class is a container for a 2D image of a
 spectrum, it also features several functions for interactively selecting
-background and data regions.
+background and data regions. Array helpers shared by both, such as the
+line binning used for mapping, are defined at module level.
 """
 
-import sys
 import pylab
-from pylab import exp, pi, log
 from scipy import special
 
+import lineshape
+import tiff
+
 class Spectrum(object):
     """ A spectrum object containing wavelengths and associated
     intensities. Operator overloading is used to provide simple
@@ -27,11 +29,11 @@ class Spectrum(object):
         are specified without intensities then all the intensities are
         initialized to zero.
         """
-        wavelengths = [float(i) for i in wavelengths]
-        intensities = [float(i) for i in intensities]
+        wavelengths = pylab.array(wavelengths, dtype=float)
+        intensities = pylab.array(intensities, dtype=float)
         if len(wavelengths) and not len(intensities):
-            self.wavelengths = pylab.array(wavelengths)
-            self.intensities = pylab.array([0.0] * len(wavelengths))
+            self.wavelengths = wavelengths
+            self.intensities = pylab.zeros(len(wavelengths))
         elif not len(wavelengths) and len(intensities):
             raise ValueError('The wavelengths for the spectrum must be '
                              'specified.')
@@ -39,8 +41,35 @@ class Spectrum(object):
             raise ValueError('The wavelengths and intensities must have the '
                              'same number of items')
         else:
-            self.wavelengths = pylab.array(wavelengths)
-            self.intensities = pylab.array(intensities)
+            self.wavelengths = wavelengths
+            self.intensities = intensities
+
+    @classmethod
+    def fromarrays(cls, wavelengths, intensities=None):
+        """ Spectrum.fromarrays(wavelengths[, intensities]) -> spec, builds
+        a spectrum from unsorted data in bulk.
+
+        The wavelengths are sorted once and the intensities of duplicate
+        wavelengths are summed, as spec1 + spec2 does for matching
+        wavelengths. Item assignment differs there, it overwrites the
+        intensity of an existing wavelength. For distinct wavelengths the
+        result is that of assigning the points one at a time, without the
+        repeated array insertions. Missing intensities are initialized to
+        zero.
+        """
+        wavelengths = pylab.asarray(wavelengths, dtype=float).ravel()
+        if intensities is None:
+            intensities = pylab.zeros(len(wavelengths))
+        intensities = pylab.asarray(intensities, dtype=float).ravel()
+        if len(wavelengths) != len(intensities):
+            raise ValueError('The wavelengths and intensities must have the '
+                             'same number of items')
+        unique, inverse = pylab.unique(wavelengths, return_inverse=True)
+        output = cls()
+        output.wavelengths = unique
+        output.intensities = pylab.bincount(inverse, weights=intensities,
+                                            minlength=len(unique))
+        return output
 
     def __add__(self, other):
         """ spec1 + spec2 -> spec3, adds spectrum objects together
@@ -50,13 +79,22 @@ class Spectrum(object):
         are added, otherwise the data from the two spectra are
         simply merged.
         """
-        output = Spectrum(self.wavelengths, self.intensities)
-        for wavelength, intensity in other:
-            if output[wavelength]:
-                output[wavelength] += intensity
-            else:
-                output[wavelength] = intensity
-        return output
+        return self.add(other)
+
+    def __iadd__(self, other):
+        """ spec1 += spec2, adds a spectrum in place
+
+        When both spectra share the same wavelength axis the intensities
+        are added directly without copying, otherwise the spectra are
+        merged as in spec1 + spec2.
+        """
+        if self._sameaxis(other):
+            self.intensities += other.intensities
+        else:
+            output = self.add(other)
+            self.wavelengths = output.wavelengths
+            self.intensities = output.intensities
+        return self
 
     def __iter__(self):
         for wavelength, intensity in zip(self.wavelengths, self.intensities):
@@ -91,12 +129,75 @@ class Spectrum(object):
         Method checks for duplicate wavelengths and properly subtracts
         the second spectrum from the first. Returns the new Spectrum object
         """
-        output = Spectrum(self.wavelengths, self.intensities)
-        for wavelength, intensity in other:
-            if output[wavelength]:
-                output[wavelength] -= intensity
-            else:
-                output[wavelength] = -intensity
+        return self.subtract(other)
+
+    def __isub__(self, other):
+        """ spec1 -= spec2, subtracts a spectrum in place
+
+        The in-place counterpart of spec1 - spec2, avoiding the copy when
+        both spectra share the same wavelength axis.
+        """
+        if self._sameaxis(other):
+            self.intensities -= other.intensities
+        else:
+            output = self.subtract(other)
+            self.wavelengths = output.wavelengths
+            self.intensities = output.intensities
+        return self
+
+    def add(self, other, tolerance=0):
+        """ Spectrum.add(other[, tolerance]) -> spec, adds two spectra
+
+        Same as spec1 + spec2, except that wavelengths of the second
+        spectrum lying within tolerance of a wavelength in the first are
+        treated as a match and added to that point.
+        """
+        return self._merge(other.wavelengths, other.intensities, tolerance)
+
+    def subtract(self, other, tolerance=0):
+        """ Spectrum.subtract(other[, tolerance]) -> spec, subtracts two
+        spectra
+
+        Same as spec1 - spec2, except that wavelengths of the second
+        spectrum lying within tolerance of a wavelength in the first are
+        treated as a match and subtracted from that point.
+        """
+        return self._merge(other.wavelengths, -pylab.asarray(other.intensities),
+                           tolerance)
+
+    def _sameaxis(self, other):
+        """ Checks whether two spectra share an identical wavelength axis.
+        """
+        return (self.wavelengths is other.wavelengths or
+                pylab.array_equal(self.wavelengths, other.wavelengths))
+
+    def _merge(self, wavelengths, intensities, tolerance):
+        """ Merges data points into a copy of the spectrum as a sorted
+        merge. Each point is matched to the nearest wavelength of the
+        spectrum and combined with it if the two are within tolerance,
+        the remaining points are inserted into the wavelength axis.
+        """
+        output = Spectrum.fromarrays(self.wavelengths, self.intensities)
+        wavelengths = pylab.asarray(wavelengths, dtype=float)
+        intensities = pylab.asarray(intensities, dtype=float)
+        n = len(output.wavelengths)
+        if n:
+            index = pylab.searchsorted(output.wavelengths, wavelengths)
+            upper = pylab.clip(index, 0, n - 1)
+            lower = pylab.clip(index - 1, 0, n - 1)
+            nearer = abs(output.wavelengths[lower] - wavelengths) < \
+                     abs(output.wavelengths[upper] - wavelengths)
+            index = pylab.where(nearer, lower, upper)
+            matched = abs(output.wavelengths[index] - wavelengths) <= tolerance
+            output.intensities += pylab.bincount(index[matched],
+                                                 weights=intensities[matched],
+                                                 minlength=n)
+            wavelengths = wavelengths[~matched]
+            intensities = intensities[~matched]
+        if len(wavelengths):
+            output = Spectrum.fromarrays(
+                pylab.concatenate((output.wavelengths, wavelengths)),
+                pylab.concatenate((output.intensities, intensities)))
         return output
     
     def show(self):
@@ -119,63 +220,50 @@ class Spectrum(object):
         maximum = max(abs(self.intensities))
         return Spectrum(self.wavelengths, ref * self.intensities/maximum)
     
-    def map(self, wavelengths):
+    def map(self, wavelengths, clip=False):
+        """ Spectrum.map(wavelengths[, clip]) -> spec, maps the spectrum
+        onto a new wavelength grid.
+
+        Each point is shared between the two neighbouring grid points by
+        linear binning, see binlines(). Points outside the grid are
+        dropped, or added to the nearest edge if clip is True.
+        """
         output = Spectrum(wavelengths)
-        for wavelength, intensity in self:
-            index, = pylab.where(output.wavelengths < wavelength)
-            try:
-                index = index[-1]
-            except IndexError:
-                output.intensities[0] += intensity
-            if index == len(output.wavelengths) + 1:
-                output.intensities[-1] += intensity
-            elif index:
-                width = output.wavelengths[index + 1] - output.wavelengths[index]
-                temp = intensity * (output.wavelengths[index + 1] \
-                       - wavelength) / width
-                output.intensities[index] += temp
-                output.intensities[index + 1] += intensity - temp
+        output.intensities = binlines(self.wavelengths, self.intensities,
+                                      output.wavelengths, clip)
         return output
             
-    def broaden(self, fwhm=1e-10, linetype=1, eta=[]):
+    def broaden(self, fwhm=1e-10, linetype=1, eta=None, width=None):
+        """ Spectrum.broaden([fwhm[, linetype[, eta[, width]]]]) -> spec,
+        convolves the spectrum with a slit function.
+
+        The wavelengths are assumed to be uniformly spaced. The linetype
+        is 1 for a Gaussian, 2 for a Lorentzian and 3 for a pseudo-Voigt
+        profile with Lorentzian fraction eta. The slit is truncated at
+        width * fwhm from its centre, see lineshape.kernel().
+        """
         output = Spectrum(self.wavelengths)
-        window = max(output.wavelengths) - min(output.wavelengths)
-        center = max(output.wavelengths) - window/2
-
-        if fwhm <= 0:
-            raise ValueError('The linewidth must be positive and nonzero.')
-
-        # Trapezoidal 
-        elif linetype is 0:
-            pass
+        spacing = (output.wavelengths[-1] - output.wavelengths[0]) \
+                  / (len(output.wavelengths) - 1)
+        output.intensities = lineshape.broaden(self.intensities, spacing,
+                                               fwhm, linetype, eta, width)
+        return output
 
-        # Gaussian
-        elif linetype is 1:
-            sigma = fwhm / (2 * log(2)**0.5)
-            slit = exp(-(output.wavelengths - center)**2/(2 * sigma**2))
-
-        # Lorentzian
-        elif linetype is 2:
-            gamma = fwhm
-            slit = 0.5 * (gamma / ((output.wavelengths - center)**2 \
-                                    + 0.25 * gamma**2)) / pi
-
-        # Pseudo-Voigt
-        elif linetype is 3:
-            if not eta:
-                print "Eta required for pseudo-Voigt profile, quitting"
-                sys.exit(0)
-            sigma = fwhm
-            sigma_g = fwhm / (2 * log(2)**0.5)
-            g = exp(-(output.wavelengths - center)**2/(2 * sigma_g**2)) \
-                / (sigma_g * (2*pi)**0.5)
-            l = (0.5 * sigma / pi) \
-                / ((output.wavelengths - center)**2 + .25 * sigma**2)
-            slit = eta * l + (1 - eta) * g
-
-
-        output.intensities = pylab.convolve(self.intensities, slit, 'same')
+    def synthesize(self, wavelengths, fwhm=1e-10, linetype=1, eta=None,
+                   width=None):
+        """ Spectrum.synthesize(wavelengths[, fwhm[, linetype[, eta[,
+        width]]]]) -> spec, broadens the spectrum onto a wavelength axis.
 
+        Treats the spectrum as stick lines and evaluates their profiles
+        directly at the given wavelengths, which need not be uniformly
+        spaced. Gives the result of map() followed by broaden() without
+        the binning error, see lineshape.synthesize().
+        """
+        output = Spectrum(wavelengths)
+        output.intensities = lineshape.synthesize(self.wavelengths,
+                                                  self.intensities,
+                                                  output.wavelengths, fwhm,
+                                                  linetype, eta, width)
         return output
 
     def inair(self):
@@ -185,24 +273,89 @@ class Spectrum(object):
             return 1e-10 * w
         self.wavelengths = [v2a(w) for w in self.wavelengths]
 
+def binlines(wavelengths, intensities, grid, clip=False):
+    """ binlines(wavelengths, intensities, grid[, clip]) -> binned
+
+    Distributes stick lines onto an ascending wavelength grid. A line
+    falling between two grid points is split between them in proportion
+    to its distance from each, a line on a grid point goes entirely to
+    that point. Lines outside the grid are dropped, unless clip is True
+    in which case they are added to the nearest edge point.
+
+    The intensities may be a 1D array matching the wavelengths or a 2D
+    (rows x lines) array, such as the output of temperature.populations(),
+    in which case every row is binned in the same call and a
+    (rows x pixels) array is returned.
+    """
+    wavelengths = pylab.asarray(wavelengths, dtype=float)
+    intensities = pylab.asarray(intensities, dtype=float)
+    grid = pylab.asarray(grid, dtype=float)
+    n = len(grid)
+    if n < 2:
+        raise ValueError('The grid must contain at least two wavelengths.')
+    if intensities.shape[-1:] != wavelengths.shape:
+        raise ValueError('The wavelengths and intensities must have the '
+                         'same number of items')
+
+    index = pylab.searchsorted(grid, wavelengths, side='right') - 1
+    index = pylab.clip(index, 0, n - 2)
+    lower = (grid[index + 1] - wavelengths) / (grid[index + 1] - grid[index])
+    if clip:
+        lower = pylab.clip(lower, 0, 1)
+    else:
+        inside = (wavelengths >= grid[0]) & (wavelengths <= grid[-1])
+        index = index[inside]
+        lower = lower[inside]
+        intensities = intensities[..., inside]
+
+    rows = intensities.reshape((int(pylab.prod(intensities.shape[:-1])),
+                                len(index)))
+    offsets = (pylab.arange(len(rows)) * n)[:, None]
+    binned = pylab.zeros(len(rows) * n)
+    binned += pylab.bincount((index + offsets).ravel(),
+                             weights=(rows * lower).ravel(),
+                             minlength=len(rows) * n)
+    binned += pylab.bincount((index + 1 + offsets).ravel(),
+                             weights=(rows * (1 - lower)).ravel(),
+                             minlength=len(rows) * n)
+    return binned.reshape(intensities.shape[:-1] + (n,))
+
 class SpectrumImage(object):
     """A 2D image of a spectrum (likely a slit image from a CCD). Provides
     methods for defining and drawing regions as background or data, 
     displaying the image, and for collapsing the image to a Spectrum
     object.
     """
-    def __init__(self, path, waveaxis=None, regions=None, start=None, end=None):
-        """ SpectrumImage(path[, waveaxis[, regions]]) initializes a new
-        spectrum image from the specified image path.
+    def __init__(self, path, waveaxis=None, regions=None, start=None, end=None,
+                 lazy=False):
+        """ SpectrumImage(path[, waveaxis[, regions[, start[, end[,
+        lazy]]]]]) initializes a new spectrum image from the specified
+        image path.
 
         Upon initialization, the image is read in to a numpy ndarray, this
         method currently assumes that 2 of the three color channels are
         redundant and eliminates them. At the time of initialization, the
         wavelength axis (0 - columns, 1 - rows) may be specified as well
         as a tuple of lists representing regions in the form [min, max].
+        With lazy set and the wavelengths along the rows (waveaxis 0), only
+        the rows covered by the regions are read into memory, see
+        tiff.read(), the rest of the image is not valid. Regions of columns
+        are read whole.
         """
-        self.image = pylab.imread(path)
-        self.image = self.image[:,:,0]
+        if lazy and regions and waveaxis == 0:
+            rows = [(region['min'], region['max']) for region in regions]
+            self.image = tiff.read(path, rows)
+            if isinstance(self.image, pylab.memmap):
+                # Reading happens here, on the loading thread, instead of
+                # where the image is first used.
+                image = pylab.zeros(self.image.shape, self.image.dtype)
+                for first, last in rows:
+                    first = max(first, 0)
+                    image[first:last + 1] = self.image[first:last + 1]
+                self.image = image
+        else:
+            self.image = pylab.imread(path)
+            self.image = self.image[:,:,0]
         self.start = start
         self.end = end
         self.regions = []
@@ -302,27 +455,149 @@ class SpectrumImage(object):
         spectrum as the method assumes all data regions represent the
         same data. The wavelength list is generated from a given start
         and end value (assumed to be in nm). Returns the data spectrum.
+        The work is done by a CollapsePlan, see there for collapsing many
+        images with the same settings.
         """
-        try:
-            wavelengths = pylab.linspace(self.start, self.end,
-                                         self.image.shape[not self.waveaxis])
-        except TypeError:
-            print 'The starting and ending wavelengths must be specified.'
-        background = pylab.zeros(len(wavelengths))
-        backgroundlines = 0
-        data = pylab.zeros(len(wavelengths))
-        datalines = 0
-        for region in self.regions:
-            if region['group'] is 0:
-                backgroundlines += region['max'] - region['min']
-                background += self.image[region['min']:region['max'] + 1, :]\
-                                  .sum(axis=self.waveaxis)
+        return CollapsePlan.fromimage(self).spectrum(self.image)
+
+class CollapsePlan(object):
+    """ The collapse of SpectrumImage compiled for fixed regions, wavelength
+    axis and image shape. The background and data regions are folded into
+    a single weight per line across the wavelength axis, so collapsing an
+    image, or a whole (frames x rows x columns) stack of them, is one
+    tensor contraction.
+    """
+
+    def __init__(self, shape, waveaxis, regions, start, end):
+        """ CollapsePlan(shape, waveaxis, regions, start, end), for images
+        of the given (rows, columns) shape, see SpectrumImage for the
+        other arguments.
+
+        As in SpectrumImage.collapse() the background and data sums are
+        divided by the sums of max - min of their regions.
+        """
+        if waveaxis not in (0, 1):
+            raise ValueError('The wavelength axis must be 0 or 1.')
+        if start is None or end is None:
+            raise ValueError('The starting and ending wavelengths must be '
+                             'specified.')
+        lines = {0: 0, 1: 0}
+        for region in regions:
+            lines[region['group'] != 0] += region['max'] - region['min']
+        if not lines[0] or not lines[1]:
+            raise ValueError('There must be background (group 0) and data '
+                             'regions, each group spanning more than one '
+                             'line.')
+        self.shape = tuple(shape[:2])
+        self.waveaxis = waveaxis
+        self.wavelengths = pylab.linspace(start, end,
+                                          self.shape[not waveaxis])
+        weights = pylab.zeros(self.shape[waveaxis])
+        background = pylab.zeros(self.shape[waveaxis], dtype=bool)
+        data = pylab.zeros(self.shape[waveaxis], dtype=bool)
+        for region in regions:
+            span = slice(region['min'], region['max'] + 1)
+            if region['group'] == 0:
+                weights[span] -= 1.0 / lines[0]
+                background[span] = True
             else:
-                datalines += region['max'] - region['min']
-                data += self.image[region['min']:region['max'] + 1, :]\
-                            .sum(axis=self.waveaxis)
-        background = [sum/backgroundlines for sum in background]
-        data = [sum/datalines for sum in data]
-        corrected = pylab.array(data) - pylab.array(background)
-        output = Spectrum(list(wavelengths), list(corrected))
-        return output
+                weights[span] += 1.0 / lines[1]
+                data[span] = True
+        used = pylab.flatnonzero(weights)
+        self.first = used.min() if len(used) else 0
+        self.last = used.max() + 1 if len(used) else 0
+        self.weights = weights[self.first:self.last]
+        # rows() subtracts the mean of the background lines from the mean
+        # of the lines of each bin.
+        background = background[self.first:self.last]
+        self.background = background / float(background.sum())
+        self.lines = pylab.flatnonzero(data[self.first:self.last])
+
+    @classmethod
+    def fromimage(cls, image):
+        """ CollapsePlan.fromimage(image) -> plan for the settings and
+        shape of a SpectrumImage.
+        """
+        return cls(image.image.shape, image.waveaxis, image.regions,
+                   image.start, image.end)
+
+    def __call__(self, images):
+        """ plan(images) -> corrected intensities
+
+        Collapses an image, or a stack of them along the first axis, to
+        (frames x pixels) background corrected intensities. Only the lines
+        covered by the regions are read.
+        """
+        images = pylab.asanyarray(images)
+        if images.shape[-2:] != self.shape:
+            raise ValueError('The images must have the shape %s the plan was '
+                             'compiled for.' % (self.shape,))
+        if self.waveaxis == 0:
+            return pylab.einsum('...rc,r->...c',
+                                images[..., self.first:self.last, :],
+                                self.weights)
+        return pylab.einsum('...cr,r->...c',
+                            images[..., :, self.first:self.last],
+                            self.weights)
+
+    def spectrum(self, image):
+        """ CollapsePlan.spectrum(image) -> Spectrum of a single image.
+        """
+        return Spectrum(self.wavelengths, self(image))
+
+    def variance(self, variances):
+        """ CollapsePlan.variance(variances) -> variance of the collapsed
+        intensities, given the per-pixel variances of the image, or of a
+        stack, such as the variance maps of combine.robust(). The inverse
+        serves as weights for fitting.
+        """
+        variances = pylab.asanyarray(variances)
+        if variances.shape[-2:] != self.shape:
+            raise ValueError('The variances must have the shape %s the plan '
+                             'was compiled for.' % (self.shape,))
+        if self.waveaxis == 0:
+            return pylab.einsum('...rc,r->...c',
+                                variances[..., self.first:self.last, :],
+                                self.weights**2)
+        return pylab.einsum('...cr,r->...c',
+                            variances[..., :, self.first:self.last],
+                            self.weights**2)
+
+    def rows(self, images, binning=1):
+        """ CollapsePlan.rows(images[, binning]) -> resolved intensities
+
+        Collapses every group of binning consecutive lines of the data
+        regions into its own spectrum, the mean of its lines less the
+        mean of the background lines, instead of all of them into one. A
+        flat image gives zero. Returns (bins x pixels) intensities for an
+        image, (frames x bins x pixels) for a stack. The last bin holds
+        the remaining lines if they do not divide evenly.
+        """
+        images = pylab.asanyarray(images)
+        if images.shape[-2:] != self.shape:
+            raise ValueError('The images must have the shape %s the plan was '
+                             'compiled for.' % (self.shape,))
+        if self.waveaxis == 0:
+            lines = images[..., self.first:self.last, :]
+        else:
+            lines = pylab.swapaxes(images[..., :, self.first:self.last], -1,
+                                   -2)
+        background = pylab.einsum('...rc,r->...c', lines, self.background)
+        starts, counts = self._bins(binning)
+        data = pylab.add.reduceat(lines[..., self.lines, :].astype(float),
+                                  starts, axis=-2)
+        return data / counts[:, None] - background[..., None, :]
+
+    def positions(self, binning=1):
+        """ CollapsePlan.positions([binning]) -> mean line index of each
+        bin of rows().
+        """
+        starts, counts = self._bins(binning)
+        return pylab.add.reduceat(self.lines + self.first, starts) / counts
+
+    def _bins(self, binning):
+        if binning < 1:
+            raise ValueError('The binning must be at least one line.')
+        starts = pylab.arange(0, len(self.lines), binning)
+        counts = pylab.diff(pylab.append(starts, len(self.lines)))
+        return starts, counts.astype(float)
@@ -0,0 +1,99 @@
+""" Reduced basis surrogate for synthetic spectra. Broadened spectra on a
+fixed detector axis change smoothly with the rotational temperature, so a
+template bank is compressed into a mean spectrum and a handful of singular
+vectors whose coefficients are interpolated in temperature with cubic
+splines. A spectrum at any temperature within the bank then costs a
+spline evaluation and a small matrix product instead of a synthesis.
+Temperatures outside the bank are refused rather than extrapolated.
+"""
+
+import pylab
+from scipy import interpolate
+
+import bank
+
+class Surrogate(object):
+    """ Singular value decomposition of a (temperatures x pixels) template
+    bank with spline interpolated coefficients. Calling the surrogate with
+    a temperature, or an array of them, returns the corresponding spectra.
+    """
+
+    def __init__(self, temperatures, templates, rank=None, tolerance=1e-6):
+        """ Surrogate(temperatures, templates[, rank[, tolerance]])
+
+        The temperatures must be ascending. Unless the rank is given, the
+        singular vectors with a singular value above tolerance times the
+        largest one are kept.
+        """
+        self.temperatures = pylab.asarray(temperatures, dtype=float)
+        templates = pylab.asarray(templates, dtype=float)
+        if templates.shape[0] != len(self.temperatures):
+            raise ValueError('There must be one template per temperature.')
+        self.mean = templates.mean(axis=0)
+        U, s, Vt = pylab.svd(templates - self.mean, full_matrices=False)
+        if rank is None:
+            rank = max(1, int((s > tolerance * s[0]).sum()))
+        self.rank = rank
+        self.singular = s
+        self.basis = Vt[:rank]
+        self.coefficients = interpolate.CubicSpline(self.temperatures,
+                                                    U[:, :rank] * s[:rank],
+                                                    axis=0)
+        self.error = None
+
+    @classmethod
+    def fromtransition(cls, istate, vi, fstate, vf, Jmax, wavelengths,
+                       temperatures, fwhm, linetype=1, eta=None,
+                       synthesis='direct', rank=None, tolerance=1e-6):
+        """ Surrogate.fromtransition(istate, vi, fstate, vf, Jmax,
+        wavelengths, temperatures, fwhm[, linetype[, eta[, synthesis[,
+        rank[, tolerance]]]]]) -> surrogate
+
+        Builds the template bank with bank.templates() and the surrogate
+        from it. The reconstruction error against the exact synthesis at
+        the midpoints of the temperature grid, the worst case for the
+        interpolation, is stored in the error attribute.
+        """
+        args = (istate, vi, fstate, vf, Jmax, wavelengths)
+        slit = (fwhm, linetype, eta, synthesis)
+        temperatures = pylab.asarray(temperatures, dtype=float)
+        output = cls(temperatures, bank.templates(*(args + (temperatures,) +
+                                                    slit)),
+                     rank, tolerance)
+        midpoints = 0.5 * (temperatures[1:] + temperatures[:-1])
+        output.validate(midpoints,
+                        bank.templates(*(args + (midpoints,) + slit)))
+        return output
+
+    def __call__(self, Tr):
+        """ surrogate(Tr) -> spectrum, or (temperatures x pixels) spectra
+        for an array of temperatures, which must lie within the bank.
+        """
+        return self.mean + pylab.dot(self.coefficients(self._check(Tr)),
+                                     self.basis)
+
+    def derivative(self, Tr):
+        """ Surrogate.derivative(Tr) -> temperature derivative of the
+        spectrum at Tr.
+        """
+        return pylab.dot(self.coefficients(self._check(Tr), 1), self.basis)
+
+    def _check(self, Tr):
+        Tr = pylab.asarray(Tr, dtype=float)
+        if (Tr < self.temperatures[0]).any() or \
+                (Tr > self.temperatures[-1]).any() or pylab.isnan(Tr).any():
+            raise ValueError('The temperatures must lie within the bank, '
+                             'from %g to %g K.' % (self.temperatures[0],
+                                                   self.temperatures[-1]))
+        return Tr
+
+    def validate(self, temperatures, exact):
+        """ Surrogate.validate(temperatures, exact) -> errors
+
+        Compares the surrogate with exactly synthesized spectra at the given
+        temperatures and returns the largest absolute difference for each.
+        The worst of them is also stored in the error attribute.
+        """
+        errors = abs(self(temperatures) - pylab.asarray(exact)).max(axis=-1)
+        self.error = pylab.atleast_1d(errors).max()
+        return errors
@@ -1,77 +1,122 @@
-from math import exp
+import pylab
 import spectrum
 
+Bx = 1.9898         # 1/cm
+h = 6.62606957e-27  # erg.sec
+c = 2.99792458e10   # cm/sec
+k = 1.3806488e-16   # erg/K
+
 def lines(istate, vi, fstate, vf, Jmax, Tr):
+    wavelengths, intensities = linelist(istate, vi, fstate, vf, Jmax, Tr)
+    return spectrum.Spectrum.fromarrays(wavelengths, intensities)
+
+def linelist(istate, vi, fstate, vf, Jmax, Tr):
+    """ linelist(istate, vi, fstate, vf, Jmax, Tr) -> wavelengths, intensities
+
+    Array counterpart of lines(). All P, Q and R sub-branches are
+    evaluated over the whole J range at once and returned, unsorted, as
+    two 1D arrays of wavelengths (m) and Boltzmann weighted intensities.
+    If Tr is a sequence of temperatures the intensities are returned as a
+    (temperatures x lines) matrix sharing the single wavelength array.
+    """
+    wavelengths, strengths, rotational = branches(istate, vi, fstate, vf, Jmax)
+    return wavelengths, populations(strengths, rotational, Jmax, Tr)
+
+def partition(Jmax, Tr):
+    """ partition(Jmax, Tr) -> Qnorm
+
+    Rotational partition function of the lower state truncated at Jmax,
+    evaluated for a single temperature or an array of temperatures.
+    """
+    Tr = pylab.asarray(Tr, dtype=float)
+    j = pylab.arange(Jmax, dtype=float)
+    x = pylab.multiply.outer(1 / Tr, j * (j + 1)) * (h * c * Bx) / k
+    return ((2 * j + 1) * pylab.exp(-x)).sum(axis=-1)
+
+def populations(strengths, rotational, Jmax, Tr):
+    """ populations(strengths, rotational, Jmax, Tr) -> intensities
+
+    Applies the Boltzmann weighting to line strengths returned from
+    branches(). For an array of temperatures this is a single outer
+    product giving a (temperatures x lines) intensity matrix.
+    """
+    Tr = pylab.asarray(Tr, dtype=float)
+    Qnorm = partition(Jmax, Tr)
+    x = pylab.multiply.outer(1 / Tr, rotational) * (h * c * Bx) / k
+    return strengths * pylab.exp(-x) / Qnorm[..., None]
+
+def dpopulations(strengths, rotational, Jmax, Tr):
+    """ dpopulations(strengths, rotational, Jmax, Tr) -> dI/dT
+
+    Analytic temperature derivative of populations(), from the derivative
+    of the Boltzmann factor of each line and of the partition function.
+    """
+    Tr = pylab.asarray(Tr, dtype=float)
+    j = pylab.arange(Jmax, dtype=float)
+    x = pylab.multiply.outer(1 / Tr, j * (j + 1)) * (h * c * Bx) / k
+    weights = (2 * j + 1) * pylab.exp(-x)
+    dlogQ = (weights * x).sum(axis=-1) / weights.sum(axis=-1) / Tr
+    x = pylab.multiply.outer(1 / Tr, rotational) * (h * c * Bx) / k
+    I = populations(strengths, rotational, Jmax, Tr)
+    return I * (x / Tr[..., None] - dlogQ[..., None])
+
+def branches(istate, vi, fstate, vf, Jmax):
+    """ branches(istate, vi, fstate, vf, Jmax) -> wavelengths, S, N
+
+    Computes the line positions and Honl-London factors of the P, Q and R
+    sub-branches for J = 0 ... Jmax as array operations. Also returns the
+    rotational factor N (J(J - 1) for the P branch, J(J + 1) otherwise)
+    that enters the Boltzmann exponent, so that the temperature dependence
+    can be applied separately.
+    """
     origin = istate.E(vi) - fstate.E(vf)
+    J = pylab.arange(Jmax + 1, dtype=float)
+
+    wavelengths = []
+    strengths = []
+    rotational = []
+    # P branch calculations
+    for O in range(3):
+        j = J[J >= O + 1]
+        shift = F(istate, vi, j - 1, O) - F(fstate, vf, j, O)
+        wavelengths.append(1 / (100 * (origin + shift)))
+        strengths.append((j + O) * (j - O) / j)
+        rotational.append(j * (j - 1))
 
-    Bx = 1.9898         # 1/cm
-    h = 6.62606957e-27  # erg.sec
-    c = 2.99792458e10   # cm/sec
-    k = 1.3806488e-16   # erg/K
-    def f(j):
-        return (2 * j + 1) * exp(-j * (j + 1) * (h * c * Bx) / (k * Tr))
-    Qnorm = sum([f(j) for j in range(Jmax)])
-    
-    # Initialize different branches, and their triplet splittings.
-    P = {0: {}, 1: {}, 2: {}}
-    Q = {1: {}, 2: {}}
-    R = {0: {}, 1: {}, 2: {}}
-    wavelengths = (P, Q, R)
-    spec = spectrum.Spectrum()
-    for J in range(Jmax+1):
-        # P branch calculations
-        for O in range(3):
-            if J - 1 < O or J < O:
-                pass
-            else:
-                shift = F(istate, vi, J - 1, O) - F(fstate, vf, J, O)
-                wavelength = 1 / (100 * (origin + shift))
-                wavelengths[0][O][J] = wavelength
-                S = (J + O) * (J - O) / J
-                I = S / Qnorm * exp(-J * (J - 1) * (h * c * Bx) / (k * Tr))
-                spec[wavelength] = I
-                
-        # Q branch calculations
-        for O in range(1,3):
-            if J < O:
-                pass
-            else:
-                shift = F(istate, vi, J, O) - F(fstate, vf, J, O)
-                wavelength = 1 / (100 * (origin + shift))
-                wavelengths[1][O][J] = wavelength
-                S = (2 * J + 1) * O * O / J
-                I = S / Qnorm * exp(-J * (J + 1) * (h * c * Bx) / (k * Tr))
-                spec[wavelength] = I
-
-        # R branch calculations
-        for O in range(3):
-            if J + 1 < O or J < O or J is 0:
-                pass
-            else:
-                shift = F(istate, vi, J + 1, O) - F(fstate, vf, J, O)
-                wavelength = 1 / (100 * (origin + shift))
-                wavelengths[2][O][J] = wavelength
-                S = (J + O) * (J - O) / J
-                I = S / Qnorm * exp(-J * (J + 1) * (h * c * Bx) / (k * Tr))
-                spec[wavelength] = I
-    return spec
+    # Q branch calculations
+    for O in range(1, 3):
+        j = J[J >= O]
+        shift = F(istate, vi, j, O) - F(fstate, vf, j, O)
+        wavelengths.append(1 / (100 * (origin + shift)))
+        strengths.append((2 * j + 1) * O * O / j)
+        rotational.append(j * (j + 1))
+
+    # R branch calculations
+    for O in range(3):
+        j = J[J >= max(O, 1)]
+        shift = F(istate, vi, j + 1, O) - F(fstate, vf, j, O)
+        wavelengths.append(1 / (100 * (origin + shift)))
+        strengths.append((j + O) * (j - O) / j)
+        rotational.append(j * (j + 1))
+
+    return (pylab.concatenate(wavelengths), pylab.concatenate(strengths),
+            pylab.concatenate(rotational))
 
 def F(state, v, J, O):
-    B = state.B
-    D = state.D
+    B = state.B(v)
+    D = state.D(v)
     Z1, Z2 = Z(state, v, J)
-    if O is 0:
-        return B(v) * (J * (J + 1) - Z1**0.5 - 2.0 * Z2) - D(v) * (J - 0.5)**4
-    elif O is 1:
-        return B(v) * (J * (J + 1) + 4 * Z2) - D(v) * (J + 0.5)**4
-    elif O is 2:
-        return B(v) * (J * (J + 1) + Z1**0.5 - 2.0 * Z2) - D(v) * (J + 1.5)**4
+    if O == 0:
+        return B * (J * (J + 1) - Z1**0.5 - 2.0 * Z2) - D * (J - 0.5)**4
+    elif O == 1:
+        return B * (J * (J + 1) + 4 * Z2) - D * (J + 0.5)**4
+    elif O == 2:
+        return B * (J * (J + 1) + Z1**0.5 - 2.0 * Z2) - D * (J + 1.5)**4
     else:
         raise ValueError('Omega was %d but can only be 0, 1 or 2' % O)
 
 def Z(state, v, J):
-    Y = state.Y
-    Z1 = Y(v) * (Y(v) - 4) + (4.0 / 3.0) + 4 * J * (J + 1)
-    Z2 = 1.0 / (3 * Z1) * (Y(v) * (Y(v) - 1) - (4.0 / 9.0) - 2 * J * (J + 1))
+    Y = state.Y(v)
+    Z1 = Y * (Y - 4) + (4.0 / 3.0) + 4 * J * (J + 1)
+    Z2 = 1.0 / (3 * Z1) * (Y * (Y - 1) - (4.0 / 9.0) - 2 * J * (J + 1))
     return Z1, Z2
-
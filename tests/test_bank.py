@@ -0,0 +1,23 @@
+import os
+
+import pylab
+
+import bank
+from gases import N2
+
+def test_hit_in_a_read_only_store(tmpdir, monkeypatch):
+    store = bank.TemplateBank(str(tmpdir))
+    args = (N2.C3Piu(), 0, N2.B3Pig(), 0, 20,
+            pylab.linspace(335e-9, 338e-9, 64), [300.0, 600.0], 0.1e-9)
+    stored = store.get(*args)
+    assert stored.shape == (2, 64)
+
+    def denied(path, times):
+        raise OSError(13, 'Permission denied', path)
+
+    def regenerated(*args):
+        raise AssertionError('The stored bank was generated again.')
+
+    monkeypatch.setattr(os, 'utime', denied)
+    monkeypatch.setattr(bank, 'templates', regenerated)
+    assert (store.get(*args) == stored).all()
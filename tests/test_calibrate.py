@@ -0,0 +1,80 @@
+import pylab
+import pytest
+
+import calibrate
+
+pixels = pylab.arange(1024.0)
+
+def comb(shift=0.0, slope=0.0, first=40, last=980, width=4.0):
+    """ Irregularly spaced lines between the pixels first and last, shifted
+    by shift at the centre of the axis with a dispersion of slope.
+    """
+    positions = pixels - shift - slope * (pixels - 511.5)
+    centres = first + (last - first) * (pylab.arange(23) * 0.618034 % 1)
+    return sum((1 + 0.5 * pylab.sin(3 * centre)) *
+               pylab.exp(-(positions - centre)**2 / (2 * width**2))
+               for centre in centres)
+
+@pytest.mark.parametrize('width', [4.0, 16.0])
+@pytest.mark.parametrize('shift', [0.3, 1.7, -4.0])
+def test_shift(shift, width):
+    calibration = calibrate.Calibration(comb(width=width))
+    offset, slope = calibration(comb(shift, width=width))
+    assert abs(offset - shift) < 0.02
+    assert slope == 0
+
+@pytest.mark.parametrize('segments', [2, 4, 8])
+@pytest.mark.parametrize('shift, slope', [(1.7, 0.002), (-4.0, -0.003)])
+def test_dispersion(segments, shift, slope):
+    calibration = calibrate.Calibration(comb(), segments)
+    offset, fitted = calibration(comb(shift, slope))
+    assert abs(offset - shift) < 0.05
+    assert abs(fitted - slope) < 1e-4
+
+@pytest.mark.parametrize('shift', [0.3, 1.7, 4.0])
+def test_band_in_one_segment(shift):
+    # Only the last segment has features, there is no slope to fit and the
+    # shift of the whole axis is returned.
+    calibration = calibrate.Calibration(comb(first=800), 4)
+    offset, slope = calibration(comb(shift, first=800))
+    assert abs(offset - shift) < 0.02
+    assert slope == 0
+
+def test_stack():
+    calibration = calibrate.Calibration(comb(), 4)
+    offsets, slopes = calibration(pylab.array([comb(0.3, 0.001),
+                                               comb(-1.0)]))
+    assert offsets.shape == slopes.shape == (2,)
+    assert abs(offsets - [0.3, -1.0]).max() < 0.05
+    assert abs(slopes - [0.001, 0.0]).max() < 1e-4
+    aligned = calibration.align(comb(2.0), 2.0)
+    assert abs(aligned - comb())[50:-50].max() < 0.05
+
+def band(decay, shift=0.0, width=12.0):
+    """ Blended lines whose heights fall off with decay, so the shape of
+    the band changes with it as with temperature.
+    """
+    centres = 300 + 400 * (pylab.arange(40) * 0.618034 % 1)
+    intensities = sum(pylab.exp(-(centre - 300) / decay -
+                                (pixels - shift - centre)**2 /
+                                (2 * width**2))
+                      for centre in centres)
+    return intensities / intensities.max()
+
+@pytest.mark.parametrize('segments', [1, 4])
+def test_bank_frames_are_correlated_with_their_template(segments):
+    decays = [50.0, 100.0, 200.0, 400.0, 800.0, 1600.0]
+    bank = pylab.array([band(decay) for decay in decays])
+    # The mean of the bank puts the features of a single band elsewhere.
+    offset, slope = calibrate.Calibration(bank.mean(axis=0))(bank[0])
+    assert abs(offset) > 1
+
+    calibration = calibrate.Calibration(bank, segments)
+    offsets, slopes = calibration(bank)
+    assert abs(offsets).max() < 0.05
+    assert abs(slopes).max() < 1e-4
+    offsets, slopes = calibration(pylab.array([band(decay, 2.5)
+                                               for decay in decays]))
+    assert abs(offsets - 2.5).max() < 0.05
+    offset, slope = calibration(band(400.0, -1.5))
+    assert abs(offset + 1.5) < 0.05
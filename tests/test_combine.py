@@ -0,0 +1,55 @@
+import os
+
+import pylab
+
+import combine
+import spectrum
+import tiff
+
+def test_variance_maps_fit_the_collapse(tmpdir):
+    frames = [pylab.full((12, 16, 3), 10 + i, dtype=pylab.uint8)
+              for i in range(5)]
+    frames[2][4, 5] = 250
+    paths = []
+    for i, frame in enumerate(frames):
+        os.makedirs(str(tmpdir.join('run%d' % i)))
+        paths.append(str(tmpdir.join('run%d' % i, '0001.tif')))
+        tiff.write(paths[-1], frame)
+    output = str(tmpdir.join('average'))
+    written, = combine.average(combine.index(paths), output, method='clip',
+                               sigma=2.0, variances=True)
+
+    image = tiff.read(written, channel=None)
+    assert image.shape == (12, 16, 3)
+    assert image[4, 5, 0] == 12
+    variance = tiff.read(os.path.join(output, 'variance', '0001.tif'),
+                         channel=None)
+    assert variance.shape == (12, 16, 1)
+    plan = spectrum.CollapsePlan((12, 16), 0,
+                                 [{'min': 0, 'max': 3, 'group': 0},
+                                  {'min': 6, 'max': 9, 'group': 1}],
+                                 330e-9, 338e-9)
+    assert plan.variance(variance[:, :, 0]).shape == (16,)
+
+def test_mean_of_paths(tmpdir):
+    paths = []
+    for i in range(3):
+        paths.append(str(tmpdir.join('f%d.tif' % i)))
+        tiff.write(paths[-1], pylab.full((4, 5), 10 * i, dtype=pylab.uint16))
+    image = combine.mean(paths, threads=2)
+    assert image.shape == (4, 5, 1)
+    assert pylab.allclose(image, 10)
+
+def test_average_without_a_method(tmpdir):
+    paths = []
+    for i in range(4):
+        os.makedirs(str(tmpdir.join('run%d' % i)))
+        paths.append(str(tmpdir.join('run%d' % i, '0001.tif')))
+        tiff.write(paths[-1], pylab.full((6, 7), 100 + 2 * i,
+                                         dtype=pylab.uint16))
+    output = str(tmpdir.join('average'))
+    written, = combine.average(combine.index(paths), output, threads=2)
+    image = tiff.read(written, channel=None)
+    assert image.dtype == pylab.uint16
+    assert image.shape == (6, 7, 1)
+    assert (image == 103).all()
@@ -0,0 +1,56 @@
+import pylab
+import pytest
+
+import fit
+from gases import N2
+
+wavelengths = pylab.linspace(334e-9, 338e-9, 256)
+spacing = wavelengths[1] - wavelengths[0]
+parameters = (600.0, 2.0, 0.01e-9, 0.08e-9)
+
+def model(synthesis):
+    return fit.Model(N2.C3Piu(), 0, N2.B3Pig(), 0, 40, wavelengths,
+                     synthesis=synthesis)
+
+# The binning of the 'convolve' synthesis is piecewise linear in the shift,
+# its derivative only agrees with a smaller step to within the kinks.
+@pytest.mark.parametrize('synthesis, tolerances', [
+    ('direct', (1e-6, 1e-6, 1e-6, 1e-6)),
+    ('convolve', (1e-6, 1e-6, 5e-2, 1e-5))])
+def test_jacobian_matches_finite_differences(synthesis, tolerances):
+    synthetic = model(synthesis)
+    intensities, J = synthetic.jacobian(*parameters)
+    assert pylab.allclose(intensities, synthetic(*parameters))
+    steps = (1e-2, 1e-6, 1e-4 * spacing, 1e-4 * parameters[3])
+    for i, (step, tolerance) in enumerate(zip(steps, tolerances)):
+        above = list(parameters)
+        below = list(parameters)
+        above[i] += step
+        below[i] -= step
+        difference = (synthetic(*above) - synthetic(*below)) / (2 * step)
+        assert abs(difference - J[:, i]).max() < \
+            tolerance * abs(J[:, i]).max()
+
+@pytest.mark.parametrize('synthesis', ['direct', 'convolve'])
+def test_fit_recovers_the_parameters(synthesis):
+    synthetic = model(synthesis)
+    result = fit.fit(synthetic, synthetic(*parameters), 500.0, 1.0, 0.0,
+                     0.1e-9)
+    assert result.success
+    assert abs(result.temperature - parameters[0]) < 1e-3
+    assert abs(result.scale - parameters[1]) < 1e-6
+    assert abs(result.shift - parameters[2]) < 1e-3 * spacing
+    assert abs(result.fwhm - parameters[3]) < 1e-3 * parameters[3]
+
+def test_fixed_parameters_keep_their_values():
+    synthetic = model('direct')
+    result = fit.fit(synthetic, synthetic(*parameters), 500.0, 1.0,
+                     parameters[2], parameters[3],
+                     free=('temperature', 'scale'))
+    assert result.shift == parameters[2] and result.fwhm == parameters[3]
+    assert sorted(result.errors) == ['scale', 'temperature']
+    assert abs(result.temperature - parameters[0]) < 1e-3
+
+def test_unknown_synthesis():
+    with pytest.raises(ValueError):
+        model('sampled')
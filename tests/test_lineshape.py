@@ -0,0 +1,18 @@
+import pylab
+import pytest
+
+import lineshape
+
+@pytest.mark.parametrize('fwhm, linetype', [(1.5, 1), (12.0, 1), (60.0, 1),
+                                            (3.0, 2), (3.0, 3)])
+def test_direct_and_fft_agree(fwhm, linetype):
+    data = pylab.rand(3, 400)
+    slit = lineshape.kernel(1.0, 400, fwhm, linetype, 0.5)
+    direct = lineshape.convolve(data, slit, 'direct')
+    fft = lineshape.convolve(data, slit, 'fft')
+    assert direct.shape == fft.shape == data.shape
+    assert pylab.allclose(direct, fft, rtol=0, atol=1e-10)
+    if len(slit) <= data.shape[-1]:
+        assert pylab.allclose(direct[1],
+                              pylab.convolve(data[1], slit, 'same'))
+    assert pylab.allclose(lineshape.convolve(data, slit), direct)
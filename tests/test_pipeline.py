@@ -0,0 +1,73 @@
+import os
+from multiprocessing.pool import ThreadPool
+
+import pylab
+
+import pipeline
+import results
+
+class Result(object):
+
+    def __init__(self, temperature):
+        self.temperature = temperature
+        self.residual = pylab.zeros(3)
+
+def source(root, count, pulled):
+    for index in range(count):
+        path = os.path.join(root, 'f%d.tif' % index)
+        if not os.path.exists(path):
+            with open(path, 'w') as fid:
+                fid.write('x' * index)
+        pulled.append(index)
+        frame = pipeline.Frame(index, path)
+        frame.signal = 1.0
+        yield frame
+
+def run(root, store, pulled):
+    stored = store.load('settings', 'model')
+    frames = pipeline.lookup(source(root, 5, pulled), stored)
+    frames = pipeline.fit(frames, lambda spectrum: Result(300.0 + len(pulled)))
+    return pipeline.record(frames, store, 'settings', 'model')
+
+def test_stored_results_are_resumed_in_place(tmpdir):
+    root = str(tmpdir.mkdir('run'))
+    store = results.ResultStore(str(tmpdir.join('results.sqlite')))
+    first = list(run(root, store, []))
+    store.flush()
+    assert [frame.index for frame in first] == list(range(5))
+    assert not any(frame.cached for frame in first)
+
+    # Frames 1 and 2 lose their results, the others come from the store and
+    # are passed on as soon as the frames before them are.
+    for index in (1, 2):
+        store.connection.execute('DELETE FROM results WHERE image = ?',
+                                 (first[index].key,))
+    pulled = []
+    second = []
+    for frame in run(root, store, pulled):
+        second.append(frame)
+        assert pulled[-1] == frame.index
+    assert [frame.cached for frame in second] == \
+        [True, False, False, True, True]
+    assert [frame.temperature for frame in second[3:]] == \
+        [frame.temperature for frame in first[3:]]
+    assert len(store.load('settings', 'model')) == 5
+    store.close()
+
+def test_parallel_keeps_cached_frames_out_of_the_pool(tmpdir):
+    frames = [pipeline.Frame(index, 'f%d' % index) for index in range(6)]
+    for frame in frames[::2]:
+        frame.cached = True
+    sent = []
+
+    def work(frame):
+        sent.append(frame.index)
+        return frame
+
+    pool = ThreadPool(2)
+    try:
+        out = list(pipeline.parallel(iter(frames), work, pool, 3))
+    finally:
+        pool.terminate()
+    assert [frame.index for frame in out] == list(range(6))
+    assert sorted(sent) == [1, 3, 5]
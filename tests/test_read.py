@@ -0,0 +1,74 @@
+import os
+import time
+
+import read
+
+def touch(path):
+    open(path, 'w').close()
+
+def test_change_within_the_mtime_tick_is_listed(tmpdir):
+    root = str(tmpdir.mkdir('run'))
+    manifest = str(tmpdir.join('manifest.json'))
+    for name in ('f9.tif', 'f10.tif'):
+        touch(os.path.join(root, name))
+    stamp = os.stat(root).st_mtime
+    assert [os.path.basename(path) for path in
+            read.Index(root, manifest).images()] == ['f9.tif', 'f10.tif']
+
+    # A file system with a coarse granularity leaves the time unchanged.
+    touch(os.path.join(root, 'f11.tif'))
+    os.utime(root, (stamp, stamp))
+    assert [os.path.basename(path) for path in
+            read.Index(root, manifest).images()] == \
+        ['f9.tif', 'f10.tif', 'f11.tif']
+
+def test_settled_directories_are_not_listed_again(tmpdir, monkeypatch):
+    root = str(tmpdir.mkdir('run'))
+    sub = os.path.join(root, 'sub')
+    os.mkdir(sub)
+    manifest = str(tmpdir.join('manifest.json'))
+    touch(os.path.join(sub, 'f1.tif'))
+    old = time.time() - 60
+    for directory in (root, sub):
+        os.utime(directory, (old, old))
+    assert len(list(read.Index(root, manifest).images())) == 1
+
+    listed = []
+    entries = read._entries
+    monkeypatch.setattr(read, '_entries',
+                        lambda directory: listed.append(directory) or
+                        entries(directory))
+    assert len(list(read.Index(root, manifest).images())) == 1
+    assert listed == []
+
+    touch(os.path.join(sub, 'f2.tif'))
+    assert [os.path.basename(path) for path in
+            read.Index(root, manifest).images()] == ['f1.tif', 'f2.tif']
+    assert listed == [sub]
+
+def test_entries_hold_no_file_stats(tmpdir):
+    root = str(tmpdir.mkdir('run'))
+    touch(os.path.join(root, 'f7.tif'))
+    entries = list(read.Index(root, str(tmpdir.join('m.json'))).entries())
+    assert entries == [(os.path.join(root, 'f7.tif'), 7)]
+
+def test_entries_after_an_image_skip_the_directories_before(tmpdir,
+                                                            monkeypatch):
+    root = str(tmpdir.mkdir('run'))
+    manifest = str(tmpdir.join('manifest.json'))
+    for directory, names in (('a', ('f1.tif',)),
+                             ('b', ('f1.tif', 'f2.tif', 'f3.tif'))):
+        os.mkdir(os.path.join(root, directory))
+        for name in names:
+            touch(os.path.join(root, directory, name))
+    assert len(list(read.Index(root, manifest).entries())) == 4
+
+    listed = []
+    entries = read._entries
+    monkeypatch.setattr(read, '_entries',
+                        lambda directory: listed.append(directory) or
+                        entries(directory))
+    after = os.path.join(root, 'b', 'f2.tif')
+    assert list(read.Index(root, manifest).entries(after)) == \
+        [(os.path.join(root, 'b', 'f3.tif'), 3)]
+    assert os.path.join(root, 'a') not in listed
@@ -0,0 +1,58 @@
+import pylab
+
+import search
+
+pixels = pylab.arange(200.0)
+grid = pylab.arange(100.0, 1901.0, 100.0)
+
+def synthesize(Tr):
+    # A line whose position follows the temperature, one pixel per 10 K.
+    return pylab.exp(-(pixels - Tr / 10.0)**2 / (2 * 15.0**2))
+
+def test_bracket_holds_the_minimum():
+    finder = search.TemperatureSearch(synthesize, grid)
+    lower, upper = finder.bracket(synthesize(637.0))
+    assert lower < 637.0 < upper
+    assert finder.bracket(synthesize(40.0)) == (100.0, 100.0)
+    templates = pylab.array([synthesize(Tr) for Tr in grid])
+    assert search.TemperatureSearch(synthesize, grid, templates).bracket(
+        synthesize(637.0)) == (lower, upper)
+
+def test_search_refines_to_the_tolerance():
+    finder = search.TemperatureSearch(synthesize, grid, tolerance=0.5)
+    Tr, error = finder(synthesize(637.0))
+    assert abs(Tr - 637.0) < 1.0
+    assert finder.previous == Tr
+
+def test_warm_start_and_fallback():
+    finder = search.TemperatureSearch(synthesize, grid, tolerance=0.5)
+    brackets = []
+    bracket = finder.bracket
+    finder.bracket = lambda intensities: brackets.append(intensities) or \
+        bracket(intensities)
+    finder(synthesize(637.0))
+    cold = finder.evaluations
+    assert len(brackets) == 1
+
+    # A close frame is found from the bracket around the previous result,
+    # which touches fewer new temperatures than the coarse grid.
+    before = finder.evaluations
+    Tr, error = finder(synthesize(652.0))
+    assert abs(Tr - 652.0) < 1.0
+    assert finder.evaluations - before < cold
+    assert len(brackets) == 1
+
+    # A jump out of the warm bracket falls back to the coarse grid.
+    Tr, error = finder(synthesize(1480.0))
+    assert abs(Tr - 1480.0) < 1.0
+    assert len(brackets) == 2
+    finder.reset()
+    assert finder.previous is None
+
+def test_memo_keys_are_rounded():
+    finder = search.TemperatureSearch(synthesize, grid, tolerance=1.0)
+    finder.spectrum(600.01)
+    finder.spectrum(600.04)
+    assert finder.evaluations == 1
+    finder.spectrum(600.2)
+    assert finder.evaluations == 2
@@ -0,0 +1,169 @@
+import struct
+
+import pylab
+import pytest
+
+import spectrum
+import tiff
+
+def scattered(path, image, per):
+    """ Writes an (rows x columns x 3) uint8 image as a TIFF whose strips of
+    per rows are stored in reverse order, so they are not contiguous and
+    tiff.read() reads them strip by strip.
+    """
+    height, width, samples = image.shape
+    strips = [image[first:first + per].tobytes()
+              for first in range(0, height, per)]
+    count = len(strips)
+    entries = 10
+    extra = 8 + 2 + 12 * entries + 4
+    bits = extra
+    offsets = bits + 6
+    counts = offsets + 4 * count
+    data = counts + 4 * count
+    positions = []
+    position = data
+    for strip in reversed(strips):
+        positions.insert(0, position)
+        position += len(strip)
+
+    def entry(tag, kind, n, value):
+        return struct.pack('<HHI', tag, kind, n) + value
+
+    fields = [entry(256, 4, 1, struct.pack('<I', width)),
+              entry(257, 4, 1, struct.pack('<I', height)),
+              entry(258, 3, 3, struct.pack('<I', bits)),
+              entry(259, 3, 1, struct.pack('<HH', 1, 0)),
+              entry(262, 3, 1, struct.pack('<HH', 2, 0)),
+              entry(273, 4, count, struct.pack('<I', offsets)),
+              entry(277, 3, 1, struct.pack('<HH', samples, 0)),
+              entry(278, 4, 1, struct.pack('<I', per)),
+              entry(279, 4, count, struct.pack('<I', counts)),
+              entry(284, 3, 1, struct.pack('<HH', 1, 0))]
+    with open(path, 'wb') as fid:
+        fid.write(b'II' + struct.pack('<HI', 42, 8))
+        fid.write(struct.pack('<H', entries) + b''.join(fields))
+        fid.write(struct.pack('<I', 0))
+        fid.write(struct.pack('<3H', 8, 8, 8))
+        fid.write(struct.pack('<%dI' % count, *positions))
+        fid.write(struct.pack('<%dI' % count, *[len(s) for s in strips]))
+        for strip in reversed(strips):
+            fid.write(strip)
+
+@pytest.mark.parametrize('waveaxis', [0, 1])
+def test_lazy_matches_eager(tmpdir, waveaxis):
+    image = pylab.randint(0, 255, (48, 64, 3)).astype(pylab.uint8)
+    path = str(tmpdir.join('frame.tif'))
+    scattered(path, image, 5)
+    settings = {'waveaxis': waveaxis, 'start': 330e-9, 'end': 338e-9,
+                'regions': [{'min': 2, 'max': 9, 'group': 0},
+                            {'min': 20, 'max': 31, 'group': 1}]}
+    eager = spectrum.SpectrumImage(path, **settings).collapse()
+    lazy = spectrum.SpectrumImage(path, lazy=True, **settings).collapse()
+    assert pylab.allclose(lazy.intensities, eager.intensities)
+    assert pylab.allclose(lazy.wavelengths, eager.wavelengths)
+
+def test_lazy_contiguous_rows_are_read_into_memory(tmpdir):
+    image = pylab.randint(0, 255, (48, 64, 3)).astype(pylab.uint8)
+    path = str(tmpdir.join('frame.tif'))
+    tiff.write(path, image)
+    settings = {'waveaxis': 0, 'start': 330e-9, 'end': 338e-9,
+                'regions': [{'min': 2, 'max': 9, 'group': 0},
+                            {'min': 20, 'max': 31, 'group': 1}]}
+    lazy = spectrum.SpectrumImage(path, lazy=True, **settings)
+    assert not isinstance(lazy.image, pylab.memmap)
+    assert (lazy.image[2:10] == image[2:10, :, 0]).all()
+    assert (lazy.image[20:32] == image[20:32, :, 0]).all()
+    eager = spectrum.SpectrumImage(path, **settings).collapse()
+    assert pylab.allclose(lazy.collapse().intensities, eager.intensities)
+
+@pytest.mark.parametrize('regions', [
+    [{'min': 20, 'max': 31, 'group': 1}],
+    [{'min': 2, 'max': 9, 'group': 0}],
+    [{'min': 2, 'max': 2, 'group': 0}, {'min': 20, 'max': 31, 'group': 1}]])
+def test_plan_needs_background_and_data(regions):
+    with pytest.raises(ValueError):
+        spectrum.CollapsePlan((48, 64), 0, regions, 330e-9, 338e-9)
+
+@pytest.mark.parametrize('waveaxis', [0, 1])
+def test_rows_of_a_flat_image_are_zero(waveaxis):
+    regions = [{'min': 2, 'max': 9, 'group': 0},
+               {'min': 20, 'max': 31, 'group': 1}]
+    plan = spectrum.CollapsePlan((48, 48), waveaxis, regions, 330e-9,
+                                 338e-9)
+    image = pylab.full((48, 48), 10.0)
+    assert pylab.allclose(plan.rows(image, 3), 0)
+    lines = slice(20, 32)
+    if waveaxis == 0:
+        image[lines] += 5
+    else:
+        image[:, lines] += 5
+    assert pylab.allclose(plan.rows(pylab.array([image, image]), 5), 5)
+
+def assigned(wavelengths, intensities):
+    """ Spectrum built by assigning the points one at a time. """
+    output = spectrum.Spectrum()
+    for wavelength, intensity in zip(wavelengths, intensities):
+        output[wavelength] = intensity
+    return output
+
+def merged(first, second, sign):
+    """ The original point by point spec1 + spec2 (sign 1) or spec1 -
+    spec2 (sign -1).
+    """
+    output = spectrum.Spectrum(first.wavelengths, first.intensities)
+    for wavelength, intensity in second:
+        if output[wavelength]:
+            output[wavelength] += sign * intensity
+        else:
+            output[wavelength] = sign * intensity
+    return output
+
+def test_fromarrays_matches_assignment():
+    wavelengths = pylab.permutation(pylab.linspace(330e-9, 338e-9, 50))
+    intensities = pylab.rand(50)
+    bulk = spectrum.Spectrum.fromarrays(wavelengths, intensities)
+    single = assigned(wavelengths, intensities)
+    assert (bulk.wavelengths == single.wavelengths).all()
+    assert (bulk.intensities == single.intensities).all()
+
+    twice = spectrum.Spectrum.fromarrays([3.0, 1.0, 3.0, 2.0],
+                                         [1.0, 2.0, 4.0, 8.0])
+    assert list(twice.wavelengths) == [1.0, 2.0, 3.0]
+    assert list(twice.intensities) == [2.0, 8.0, 5.0]
+
+def test_add_and_subtract_match_the_point_loop():
+    grid = pylab.linspace(330e-9, 338e-9, 40)
+    first = spectrum.Spectrum.fromarrays(grid[::2], 1 + pylab.rand(20))
+    second = spectrum.Spectrum.fromarrays(grid[::3], 1 + pylab.rand(14))
+    for result, sign in ((first + second, 1), (first - second, -1)):
+        expected = merged(first, second, sign)
+        assert pylab.allclose(result.wavelengths, expected.wavelengths)
+        assert pylab.allclose(result.intensities, expected.intensities)
+
+def test_tolerance_matches_the_nearest_point():
+    first = spectrum.Spectrum.fromarrays([1.0, 2.0, 3.0], [1.0, 1.0, 1.0])
+    second = spectrum.Spectrum.fromarrays([1.05, 1.9, 2.5, 4.0],
+                                          [1.0, 2.0, 4.0, 8.0])
+    added = first.add(second, tolerance=0.15)
+    assert list(added.wavelengths) == [1.0, 2.0, 2.5, 3.0, 4.0]
+    assert pylab.allclose(added.intensities, [2.0, 3.0, 4.0, 1.0, 8.0])
+    subtracted = first.subtract(second, tolerance=0.15)
+    assert pylab.allclose(subtracted.intensities, [0.0, -1.0, -4.0, 1.0,
+                                                   -8.0])
+    exact = first.add(second)
+    assert len(exact.wavelengths) == 7
+
+def test_binlines_edges():
+    grid = pylab.array([0.0, 1.0, 2.0, 4.0])
+    wavelengths = pylab.array([-1.0, 0.0, 0.25, 3.0, 4.0, 5.0])
+    intensities = pylab.array([1.0, 2.0, 4.0, 8.0, 16.0, 32.0])
+    binned = spectrum.binlines(wavelengths, intensities, grid)
+    assert pylab.allclose(binned, [2.0 + 3.0, 1.0, 4.0, 4.0 + 16.0])
+    clipped = spectrum.binlines(wavelengths, intensities, grid, clip=True)
+    assert pylab.allclose(clipped, [1.0 + 2.0 + 3.0, 1.0, 4.0,
+                                    4.0 + 16.0 + 32.0])
+    assert pylab.allclose(clipped.sum(), intensities.sum())
+    stack = spectrum.binlines(wavelengths, [intensities, 2 * intensities],
+                              grid, clip=True)
+    assert pylab.allclose(stack, [clipped, 2 * clipped])
@@ -0,0 +1,38 @@
+import pylab
+import pytest
+
+import bank
+import surrogate
+from gases import N2
+
+wavelengths = pylab.linspace(334e-9, 338e-9, 256)
+temperatures = pylab.arange(300.0, 2001.0, 50.0)
+transition = (N2.C3Piu(), 0, N2.B3Pig(), 0, 40, wavelengths)
+
+@pytest.fixture(scope='module')
+def reduced():
+    return surrogate.Surrogate.fromtransition(*(transition +
+                                                (temperatures, 0.08e-9)))
+
+def test_reconstruction_error(reduced):
+    assert reduced.rank < len(temperatures)
+    assert reduced.error < 1e-3
+    exact = bank.templates(*(transition + ([317.0, 1234.5], 0.08e-9)))
+    errors = reduced.validate([317.0, 1234.5], exact)
+    assert errors.shape == (2,)
+    assert errors.max() < 1e-3
+    nodes = bank.templates(*(transition + (temperatures[::7], 0.08e-9)))
+    assert abs(reduced(temperatures[::7]) - nodes).max() < 1e-6
+
+def test_derivative(reduced):
+    step = 0.1
+    difference = (reduced(800.0 + step) - reduced(800.0 - step)) / (2 * step)
+    assert pylab.allclose(reduced.derivative(800.0), difference, rtol=0,
+                          atol=1e-6 * abs(difference).max())
+
+@pytest.mark.parametrize('Tr', [250.0, 2100.0, float('nan')])
+def test_refuses_temperatures_outside_the_bank(reduced, Tr):
+    with pytest.raises(ValueError):
+        reduced(Tr)
+    with pytest.raises(ValueError):
+        reduced.derivative(Tr)
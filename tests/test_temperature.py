@@ -0,0 +1,64 @@
+import math
+
+import pylab
+import pytest
+
+import temperature
+from gases import N2
+
+def loop(istate, vi, fstate, vf, Jmax):
+    """ Line positions, Honl-London factors and rotational factors by the
+    per-line loop of the original temperature.lines(), in the order of
+    branches().
+    """
+    origin = istate.E(vi) - fstate.E(vf)
+    F = temperature.F
+    P, Q, R = [], [], []
+    for O in range(3):
+        for J in range(Jmax + 1):
+            if not (J - 1 < O or J < O):
+                shift = F(istate, vi, J - 1, O) - F(fstate, vf, J, O)
+                P.append((1 / (100 * (origin + shift)),
+                          (J + O) * (J - O) / float(J), J * (J - 1)))
+    for O in range(1, 3):
+        for J in range(Jmax + 1):
+            if not J < O:
+                shift = F(istate, vi, J, O) - F(fstate, vf, J, O)
+                Q.append((1 / (100 * (origin + shift)),
+                          (2 * J + 1) * O * O / float(J), J * (J + 1)))
+    for O in range(3):
+        for J in range(Jmax + 1):
+            if not (J + 1 < O or J < O or J == 0):
+                shift = F(istate, vi, J + 1, O) - F(fstate, vf, J, O)
+                R.append((1 / (100 * (origin + shift)),
+                          (J + O) * (J - O) / float(J), J * (J + 1)))
+    return pylab.array(P + Q + R).T
+
+@pytest.mark.parametrize('Jmax', [1, 2, 50])
+def test_branches_match_the_line_loop(Jmax):
+    states = (N2.C3Piu(), 0, N2.B3Pig(), 0, Jmax)
+    wavelengths, strengths, rotational = temperature.branches(*states)
+    expected = loop(*states)
+    assert pylab.allclose(wavelengths, expected[0], rtol=1e-12, atol=0)
+    assert pylab.allclose(strengths, expected[1], rtol=1e-12, atol=0)
+    assert (rotational == expected[2]).all()
+
+    # The Boltzmann weighting of the loop, one line at a time.
+    Tr = 700.0
+    scale = temperature.h * temperature.c * temperature.Bx / temperature.k
+    Qnorm = sum((2 * j + 1) * math.exp(-j * (j + 1) * scale / Tr)
+                for j in range(Jmax))
+    weighted = [S / Qnorm * math.exp(-N * scale / Tr)
+                for S, N in zip(expected[1], expected[2])]
+    assert pylab.allclose(temperature.populations(strengths, rotational,
+                                                  Jmax, Tr),
+                          weighted, rtol=1e-12, atol=0)
+
+def test_lines_weight_every_line_once():
+    states = (N2.C3Piu(), 0, N2.B3Pig(), 0, 30)
+    wavelengths, intensities = temperature.linelist(*(states + (600.0,)))
+    spectrum = temperature.lines(*(states + (600.0,)))
+    assert pylab.allclose(spectrum.intensities.sum(), intensities.sum())
+    assert (pylab.diff(spectrum.wavelengths) > 0).all()
+    stack = temperature.linelist(*(states + ([300.0, 600.0],)))[1]
+    assert pylab.allclose(stack[1], intensities)
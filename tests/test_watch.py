@@ -0,0 +1,46 @@
+import os
+
+import pylab
+
+import tiff
+import watch
+
+def image(path, complete=True):
+    tiff.write(path, pylab.zeros((8, 8), dtype=pylab.uint16))
+    if not complete:
+        with open(path, 'rb') as fid:
+            data = fid.read()
+        with open(path, 'wb') as fid:
+            fid.write(data[:len(data) // 2])
+
+def names(paths):
+    return [os.path.basename(path) for path in paths]
+
+def test_frames_keep_their_order_when_written_out_of_order(tmpdir):
+    root = str(tmpdir.mkdir('run'))
+    image(os.path.join(root, 'f1.tif'), complete=False)
+    image(os.path.join(root, 'f2.tif'))
+    watcher = watch.Watcher(root, manifest=str(tmpdir.join('m.json')))
+    assert watcher.poll() == []
+    assert watcher.poll() == []
+
+    image(os.path.join(root, 'f1.tif'))
+    image(os.path.join(root, 'f10.tif'))
+    assert watcher.poll() == []
+    assert names(watcher.poll()) == ['f1.tif']
+    assert names(watcher.poll()) == ['f2.tif']
+    assert names(watcher.poll()) == ['f10.tif']
+    assert watcher.poll() == []
+    assert watcher.sizes == {}
+
+def test_resume_skips_the_recorded_paths(tmpdir):
+    root = str(tmpdir.mkdir('run'))
+    paths = [os.path.join(root, 'f%d.tif' % i) for i in (1, 2, 3, 4)]
+    for path in paths:
+        image(path)
+    watcher = watch.Watcher(root, 0.01, [paths[0], paths[2]], 0.2,
+                            str(tmpdir.join('m.json')))
+    frames = list(watcher)
+    assert [(frame.index, frame.path) for frame in frames] == \
+        [(1, paths[1]), (3, paths[3])]
+    assert watcher.done == set()
@@ -0,0 +1,198 @@
+""" Reading of selected rows and a single channel of TIFF images. The strips
+of uncompressed images are memory-mapped, so only the pages holding the
+requested rows are ever read from disk and the other color channels are
+never copied. Compressed images, or any layout not handled here, fall back
+to decoding the whole image with pylab.imread(). Arrays are written as
+uncompressed single strip images, which are read back the fast way.
+"""
+
+import os
+import struct
+
+import pylab
+
+# Tags used from the image file directory.
+WIDTH = 256
+LENGTH = 257
+BITS = 258
+COMPRESSION = 259
+STRIPOFFSETS = 273
+SAMPLES = 277
+ROWSPERSTRIP = 278
+STRIPBYTECOUNTS = 279
+PLANAR = 284
+SAMPLEFORMAT = 339
+
+# Sizes and struct codes of the TIFF field types.
+types = {1: 'B', 3: 'H', 4: 'I'}
+kinds = {1: 'u', 2: 'i', 3: 'f'}
+
+def header(path):
+    """ header(path) -> dict of tag: value(s) of the first image, or None
+    if the file is not a TIFF.
+    """
+    fid = open(path, 'rb')
+    try:
+        order = fid.read(2)
+        if order == b'II':
+            endian = '<'
+        elif order == b'MM':
+            endian = '>'
+        else:
+            return None
+        magic, = struct.unpack(endian + 'H', fid.read(2))
+        if magic != 42:
+            return None
+        offset, = struct.unpack(endian + 'I', fid.read(4))
+        fid.seek(offset)
+        count, = struct.unpack(endian + 'H', fid.read(2))
+        entries = fid.read(12 * count)
+        tags = {'endian': endian}
+        for i in range(count):
+            tag, kind, n, value = struct.unpack(endian + 'HHI4s',
+                                                entries[12*i:12*i + 12])
+            if kind not in types:
+                continue
+            code = endian + '%d%s' % (n, types[kind])
+            size = struct.calcsize(code)
+            if size > 4:
+                position = fid.tell()
+                fid.seek(struct.unpack(endian + 'I', value)[0])
+                value = fid.read(size)
+                fid.seek(position)
+            values = struct.unpack(code, value[:size])
+            tags[tag] = values[0] if n == 1 else values
+        return tags
+    finally:
+        fid.close()
+
+def complete(path):
+    """ complete(path) -> True if the file holds a TIFF header and every
+    strip of the first image, False for a file still being written.
+    """
+    try:
+        tags = header(path)
+        size = os.path.getsize(path)
+    except (IOError, OSError, struct.error):
+        return False
+    if tags is None or STRIPOFFSETS not in tags or \
+            STRIPBYTECOUNTS not in tags:
+        return False
+    ends = pylab.atleast_1d(tags[STRIPOFFSETS]) + \
+        pylab.atleast_1d(tags[STRIPBYTECOUNTS])
+    return ends.max() <= size
+
+def read(path, rows=None, channel=0):
+    """ read(path[, rows[, channel]]) -> (rows x columns) image
+
+    Returns a single channel of the image, or all of them as a (rows x
+    columns x channels) image for a channel of None. If rows, a list of
+    (first, last) inclusive row ranges, is given only those rows are
+    guaranteed to be read, the others may be left zero. Uncompressed
+    images with contiguous strips are returned as a memory-mapped view.
+    """
+    tags = header(path)
+    if tags is None or tags.get(COMPRESSION, 1) != 1 or \
+            tags.get(PLANAR, 1) != 1:
+        return _decode(path, channel)
+    bits = tags.get(BITS, 1)
+    if not isinstance(bits, tuple):
+        bits = (bits,)
+    kind = tags.get(SAMPLEFORMAT, 1)
+    if isinstance(kind, tuple):
+        kind = kind[0]
+    if bits[0] % 8 or len(set(bits)) > 1 or kind not in kinds:
+        return _decode(path, channel)
+    dtype = pylab.dtype(tags['endian'] + kinds[kind] + str(bits[0] // 8))
+    height, width = tags[LENGTH], tags[WIDTH]
+    samples = tags.get(SAMPLES, 1)
+    offsets = pylab.atleast_1d(tags[STRIPOFFSETS])
+    per = min(tags.get(ROWSPERSTRIP, height), height)
+    stride = width * samples * dtype.itemsize
+    if channel is None:
+        channel = slice(None)
+    else:
+        channel = min(channel, samples - 1)
+
+    if (pylab.diff(offsets) == per * stride).all():
+        image = pylab.memmap(path, dtype, 'r', offsets[0],
+                             (height, width, samples))
+        return image[:, :, channel]
+
+    # Scattered strips, only those covering the rows are read.
+    if rows is None:
+        rows = [(0, height - 1)]
+    output = pylab.zeros((height, width, samples), dtype)[:, :, channel]
+    needed = set()
+    for first, last in rows:
+        first, last = max(first, 0), min(last, height - 1)
+        needed.update(range(first // per, last // per + 1))
+    fid = open(path, 'rb')
+    try:
+        for strip in sorted(needed):
+            first = strip * per
+            count = min(per, height - first)
+            fid.seek(offsets[strip])
+            data = pylab.frombuffer(fid.read(count * stride), dtype)
+            output[first:first + count] = \
+                data.reshape(count, width, samples)[:, :, channel]
+    finally:
+        fid.close()
+    return output
+
+def write(path, image):
+    """ write(path, image), writes a (rows x columns) grayscale or (rows x
+    columns x channels) image of unsigned or signed integers or floats as
+    an uncompressed TIFF.
+    """
+    image = pylab.ascontiguousarray(image)
+    if image.ndim == 2:
+        image = image[:, :, None]
+    if image.ndim != 3 or image.dtype.kind not in 'uif':
+        raise ValueError('The image must be a 2D or 3D array of numbers.')
+    image = image.astype(image.dtype.newbyteorder('<'))
+    height, width, samples = image.shape
+    bits = 8 * image.dtype.itemsize
+    kind = dict((value, key) for key, value in kinds.items())
+    entries = [(WIDTH, 4, [width]), (LENGTH, 4, [height]),
+               (BITS, 3, [bits] * samples), (COMPRESSION, 3, [1]),
+               (262, 3, [2 if samples >= 3 else 1]),
+               (STRIPOFFSETS, 4, [0]), (SAMPLES, 3, [samples]),
+               (ROWSPERSTRIP, 4, [height]),
+               (STRIPBYTECOUNTS, 4, [image.nbytes]),
+               (PLANAR, 3, [1]),
+               (SAMPLEFORMAT, 3, [kind[image.dtype.kind]] * samples)]
+    # Header, directory, values that do not fit an entry, then the pixels.
+    directory = 8
+    extra = directory + 2 + 12 * len(entries) + 4
+    values = b''
+    fields = []
+    for tag, code, data in entries:
+        packed = struct.pack('<%d%s' % (len(data), types[code]), *data)
+        if len(packed) > 4:
+            fields.append((tag, code, len(data), extra + len(values)))
+            values += packed
+        else:
+            fields.append((tag, code, len(data), packed.ljust(4, b'\0')))
+    start = extra + len(values)
+    fid = open(path, 'wb')
+    try:
+        fid.write(b'II' + struct.pack('<HI', 42, directory))
+        fid.write(struct.pack('<H', len(fields)))
+        for tag, code, count, value in fields:
+            if tag == STRIPOFFSETS:
+                value = struct.pack('<I', start)
+            elif not isinstance(value, bytes):
+                value = struct.pack('<I', value)
+            fid.write(struct.pack('<HHI', tag, code, count) + value)
+        fid.write(struct.pack('<I', 0))
+        fid.write(values)
+        fid.write(image.tobytes())
+    finally:
+        fid.close()
+
+def _decode(path, channel):
+    image = pylab.imread(path)
+    if image.ndim == 3 and channel is not None:
+        image = image[:, :, channel]
+    return image
@@ -0,0 +1,97 @@
+""" Live acquisition: frames are handed to the pipeline as the camera
+writes them. The acquisition directory is listed through the cached index
+of read.py, so every poll only lists directories that changed and skips
+those before the last frame, and a new image is passed on once its size
+has stayed the same between two polls and all of its strips are on disk.
+Where the inotify_simple package is available, polls are triggered by
+file system events instead of waiting out the interval.
+"""
+
+import os
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+import pipeline
+import read
+import tiff
+
+class Watcher(object):
+    """ Generates a pipeline.Frame for every image written to a directory,
+    in natural order, indexed by its position in that order. The images in
+    done, the paths a previous run handled, are counted but skipped, so a
+    restarted run carries on where the last one stopped. Frames are passed
+    on in order, an image that appears before the last frame passed on is
+    left out.
+    """
+
+    def __init__(self, directory, interval=0.2, done=(), timeout=None,
+                 manifest=None):
+        """ Watcher(directory[, interval[, done[, timeout[, manifest]]]])
+
+        The directory is polled every interval seconds. Iteration ends
+        once no new image has appeared for timeout seconds, by default it
+        never does. The manifest is passed on to read.Index.
+        """
+        self.directory = directory
+        self.interval = interval
+        self.index = 0
+        self.done = set(done)
+        self.last = None
+        self.timeout = timeout
+        self.listing = read.Index(directory, manifest)
+        self.sizes = {}
+        self.notify = None
+        if INotify is not None:
+            self.notify = INotify()
+            self.notify.add_watch(directory, flags.CREATE | flags.MODIFY |
+                                  flags.CLOSE_WRITE | flags.MOVED_TO)
+
+    def poll(self):
+        """ Watcher.poll() -> list of the paths of the new and complete
+        images, and of those in done. An incomplete image holds back all
+        images after it, so frames keep their order.
+        """
+        ready = []
+        for path, frame in self.listing.entries(self.last):
+            if path in self.done:
+                self.last = path
+                ready.append(path)
+                continue
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                break
+            if self.sizes.get(path) != size or not tiff.complete(path):
+                self.sizes[path] = size
+                break
+            del self.sizes[path]
+            self.last = path
+            ready.append(path)
+        return ready
+
+    def wait(self):
+        """ Blocks until the next poll is due, or a file system event
+        arrives.
+        """
+        if self.notify is not None:
+            self.notify.read(timeout=int(1000 * self.interval))
+        else:
+            time.sleep(self.interval)
+
+    def __iter__(self):
+        last = time.time()
+        while True:
+            for path in self.poll():
+                last = time.time()
+                self.index += 1
+                if path in self.done:
+                    self.done.discard(path)
+                    continue
+                yield pipeline.Frame(self.index - 1, path)
+            if self.timeout is not None and time.time() - last > self.timeout:
+                return
+            self.wait()